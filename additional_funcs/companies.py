@@ -1,30 +1,14 @@
+import asyncio
+import datetime
+
 from bson import ObjectId
 from fastapi import HTTPException
-import os
+from pymongo import ReplaceOne, DeleteMany
 
 import config
-
-
-async def delete_object_ids_from_list(the_lists: list):
-    for elem_id in range(len(the_lists)):
-        if isinstance(the_lists[elem_id], ObjectId):
-            the_lists[elem_id] = str(the_lists[elem_id])
-        elif isinstance(the_lists[elem_id], dict):
-            the_lists[elem_id] = await delete_object_ids_from_dict(the_lists[elem_id])
-        elif isinstance(the_lists[elem_id], list):
-            the_lists[elem_id] = await delete_object_ids_from_list(the_lists[elem_id])
-    return the_lists
-
-
-async def delete_object_ids_from_dict(the_dict: dict):
-    for elem in the_dict.keys():
-        if isinstance(the_dict[elem], ObjectId):
-            the_dict[elem] = str(the_dict[elem])
-        elif isinstance(the_dict[elem], dict):
-            the_dict[elem] = await delete_object_ids_from_dict(the_dict[elem])
-        elif isinstance(the_dict[elem], list):
-            the_dict[elem] = await delete_object_ids_from_list(the_dict[elem])
-    return the_dict
+from additional_funcs import files as files_additional_funcs
+from additional_funcs import jobs as jobs_additional_funcs
+from middlewares.principal_cache import principal_cache
 
 
 async def fill_in_object_ids_list(the_list: list):
@@ -50,22 +34,115 @@ async def fill_in_object_ids_dict(the_dict: dict):
 
 
 async def get_company(company_id: str):
-    current_company = config.db.companies.find_one({"_id": ObjectId(company_id)})
+    current_company = await config.db.companies.find_one({"_id": ObjectId(company_id)})
     if current_company is not None:
-        return await delete_object_ids_from_dict(current_company)
+        return current_company
     raise HTTPException(status_code=404, detail='Could not find the current_company')
 
 
-async def unset_company_at_users_files(company_id: str):
-    config.db.users.update({"company_id": ObjectId(company_id)},
-                           {"$set": {"company_id": None,
-                                     "division_id": None,
-                                     "role_id": None}})
-    files = list(config.db.files.find({"company_id": ObjectId(company_id)}))
-    for file in files:
-        try:
-            os.remove(file['path'])
-            os.remove(file['preview_path'])
-        except FileNotFoundError as e:
-            print(e)
-    config.db.files.remove({"company_id": ObjectId(company_id)})
+def get_company_roles(company: dict):
+    roles = list()
+    for division in company.get('divisions', list()):
+        for role in division.get('available_roles', list()):
+            roles.append({"_id": role['role_id'],
+                          "company_id": company['_id'],
+                          "division_id": division['division_id'],
+                          "division_name": division['name'],
+                          "role_name": role['name'],
+                          "permissions": role['permissions']})
+    return roles
+
+
+async def index_company_roles(company: dict):
+    roles = get_company_roles(company)
+    requests = [ReplaceOne({"_id": role["_id"]}, role, upsert=True) for role in roles]
+    requests.append(DeleteMany({"company_id": company['_id'], "_id": {"$nin": [role["_id"] for role in roles]}}))
+    await config.db.role_index.bulk_write(requests, ordered=False)
+
+
+async def unindex_company_roles(company_id: str):
+    await config.db.role_index.delete_many({"company_id": ObjectId(company_id)})
+
+
+async def rebuild_role_index():
+    async for company in config.db.companies.find({}, {"divisions": 1}):
+        await index_company_roles(company)
+
+
+# what a deleted part of a company leaves behind: collection, field that points at the part, fields to unset
+cascades = {
+    'third_party': [("files", "third_party_id", ("third_party_id", "third_party_folder_id"))],
+    'third_party_folder': [("files", "third_party_folder_id", ("third_party_folder_id",))],
+    'available_signer': [("files", "available_signer_id", ("available_signer_id",))],
+    'division': [("files", "division_id", ("division_id",)),
+                 ("users", "division_id", ("division_id", "role_id"))],
+    'role': [("users", "role_id", ("role_id",))],
+}
+
+
+async def enqueue_cascade(company_id: str, user_id: str, part: str, part_id: str):
+    return await jobs_additional_funcs.enqueue('cascade', company_id, user_id,
+                                               dict(part=part, part_id=ObjectId(part_id)))
+
+
+@jobs_additional_funcs.job_handler('cascade')
+async def cascade_job(job: dict):
+    """
+    Unsets the ids of a deleted part of a company, a batch at a time through the company_id indexes
+    """
+    part_id = job['params']['part_id']
+    for collection, field, unset_fields in cascades[job['params']['part']]:
+        updated = job['progress'].get(collection, 0)
+        while True:
+            batch = await config.db[collection].find({"company_id": job['company_id'], field: part_id},
+                                                     {"_id": 1}).to_list(length=config.cascade_batch_size)
+            ids = [elem['_id'] for elem in batch]
+            if len(ids) == 0:
+                break
+            result = await config.db[collection].update_many({"_id": {"$in": ids}, field: part_id},
+                                                             {"$set": {key: None for key in unset_fields}})
+            updated += result.modified_count
+            await jobs_additional_funcs.update_progress(job, **{collection: updated})
+
+
+@jobs_additional_funcs.job_handler('delete_company')
+async def delete_company_job(job: dict):
+    """
+    Removes a company marked as deleting. Files are read with one cursor and removed in batches,
+    a file document is deleted before its blob is released, so a job run again never releases a blob twice
+    """
+    company_id = job['company_id']
+    # users who signed up into the company store its id as a string
+    users_filter = {"company_id": {"$in": [company_id, str(company_id)]}}
+    user_ids = [user['_id'] for user in await config.db.users.find(users_filter, {"_id": 1}).to_list(length=None)]
+    recent_change = str(datetime.datetime.now().timestamp()).replace('.', '')
+    await config.db.users.update_many(users_filter,
+                                      {"$set": {"company_id": None,
+                                                "division_id": None,
+                                                "role_id": None,
+                                                "recent_change": recent_change}})
+    await asyncio.gather(*[principal_cache.user_changed(str(user_id), recent_change) for user_id in user_ids])
+    await jobs_additional_funcs.update_progress(job, users_detached=True)
+    files_deleted = job['progress'].get('files_deleted', 0)
+    batch = list()
+    async for file in config.db.files.find({"company_id": company_id},
+                                           {"path": 1, "preview_path": 1, "sha256": 1},
+                                           batch_size=config.company_delete_batch_size):
+        batch.append(file)
+        if len(batch) == config.company_delete_batch_size:
+            files_deleted += await delete_files_batch(batch)
+            await jobs_additional_funcs.update_progress(job, files_deleted=files_deleted)
+            batch = list()
+    if len(batch) != 0:
+        files_deleted += await delete_files_batch(batch)
+        await jobs_additional_funcs.update_progress(job, files_deleted=files_deleted)
+    await unindex_company_roles(str(company_id))
+    await config.db.companies.delete_one({"_id": company_id})
+    await principal_cache.company_changed(str(company_id), str(datetime.datetime.now().timestamp()).replace('.', ''))
+    await jobs_additional_funcs.update_progress(job, company_deleted=True)
+
+
+async def delete_files_batch(files: list):
+    deleted = await config.db.files.delete_many({"_id": {"$in": [file['_id'] for file in files]}})
+    await files_additional_funcs.release_file_blobs(files)
+    return deleted.deleted_count
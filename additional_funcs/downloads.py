@@ -0,0 +1,194 @@
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+from urllib.parse import quote
+
+from bson import ObjectId
+from fastapi import Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.requests import Request
+from fastapi.responses import StreamingResponse
+
+import config
+
+
+def make_etag(*parts):
+    return '"' + '-'.join(str(part) for part in parts) + '"'
+
+
+def content_disposition(filename: str):
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+def etag_matches(header: str, etag: str, weak: bool = True):
+    for value in header.split(','):
+        value = value.strip()
+        if value == '*':
+            return True
+        if weak and value.startswith('W/'):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+
+def is_not_modified(request: Request, etag: str, mtime: float):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def range_is_current(request: Request, etag: str, mtime: float):
+    if_range = request.headers.get('if-range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # only a strong validator can resume a download
+        return etag_matches(if_range, etag, weak=False)
+    try:
+        return int(mtime) == parsedate_to_datetime(if_range).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_range_header(range_header: str, size: int):
+    """
+    Returns a list of (start, end) byte positions, an empty list if none of the ranges can be satisfied,
+    or None if the header has to be ignored and the whole file sent
+    """
+    unit, _, ranges_spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = list()
+    for spec in ranges_spec.split(','):
+        spec = spec.strip()
+        if spec == '':
+            continue
+        start, separator, end = spec.partition('-')
+        start, end = start.strip(), end.strip()
+        if separator == '' or (start == '' and end == '') \
+                or (start != '' and not start.isdigit()) or (end != '' and not end.isdigit()):
+            return None
+        if start == '':
+            if int(end) == 0 or size == 0:
+                continue
+            ranges.append((max(size - int(end), 0), size - 1))
+            continue
+        if end != '' and int(end) < int(start):
+            return None
+        if int(start) >= size:
+            continue
+        ranges.append((int(start), size - 1 if end == '' else min(int(end), size - 1)))
+    if len(ranges) > config.download_max_ranges:
+        return None
+    return ranges
+
+
+async def iter_file_parts(doc, parts: list, closing: bytes = b''):
+    try:
+        for prefix, start, end in parts:
+            if prefix:
+                yield prefix
+            await run_in_threadpool(doc.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await run_in_threadpool(doc.read, min(config.download_chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        if closing:
+            yield closing
+    finally:
+        await run_in_threadpool(doc.close)
+
+
+async def file_response(request: Request, path: str, media_type: str, etag: str, cache_control: str,
+                        filename: Optional[str] = None):
+    """
+    Sends the file with validators, answers conditional requests with 304 and range requests with 206.
+    Raises FileNotFoundError if the file is missing.
+    """
+    doc = await run_in_threadpool(open, path, 'rb')
+    try:
+        stat = await run_in_threadpool(os.fstat, doc.fileno())
+    except BaseException:
+        doc.close()
+        raise
+    size = stat.st_size
+    media_type = media_type or 'application/octet-stream'
+    headers = {"etag": etag,
+               "last-modified": formatdate(stat.st_mtime, usegmt=True),
+               "cache-control": cache_control,
+               "accept-ranges": "bytes"}
+    if filename is not None:
+        headers["content-disposition"] = content_disposition(filename)
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        await run_in_threadpool(doc.close)
+        return Response(status_code=304, headers=headers)
+
+    ranges = None
+    range_header = request.headers.get('range')
+    if range_header is not None and range_is_current(request, etag, stat.st_mtime):
+        ranges = parse_range_header(range_header, size)
+    if ranges is not None and len(ranges) == 0:
+        await run_in_threadpool(doc.close)
+        headers["content-range"] = f'bytes */{size}'
+        return Response(status_code=416, headers=headers)
+
+    if ranges is None:
+        headers["content-length"] = str(size)
+        return StreamingResponse(iter_file_parts(doc, [(b'', 0, size - 1)]), media_type=media_type,
+                                 headers=headers)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-range"] = f'bytes {start}-{end}/{size}'
+        headers["content-length"] = str(end - start + 1)
+        return StreamingResponse(iter_file_parts(doc, [(b'', start, end)]), status_code=206,
+                                 media_type=media_type, headers=headers)
+
+    boundary = str(ObjectId())
+    parts = list()
+    for index, (start, end) in enumerate(ranges):
+        prefix = ('\r\n' if index != 0 else '') + f'--{boundary}\r\n' \
+                                                  f'Content-Type: {media_type}\r\n' \
+                                                  f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+        parts.append((prefix.encode(), start, end))
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+    headers["content-length"] = str(sum(len(prefix) + end - start + 1 for prefix, start, end in parts)
+                                    + len(closing))
+    return StreamingResponse(iter_file_parts(doc, parts, closing), status_code=206,
+                             media_type=f'multipart/byteranges; boundary={boundary}', headers=headers)
+
+
+def offload_response(path: str, media_type: str, cache_control: str, filename: Optional[str] = None):
+    """
+    Leaves sending the file to the front proxy, which also answers the conditional and range requests
+    """
+    headers = {"cache-control": cache_control}
+    if filename is not None:
+        headers["content-disposition"] = content_disposition(filename)
+    if config.file_delivery_mode == 'x-accel-redirect':
+        headers["x-accel-redirect"] = config.file_delivery_internal_prefix + quote(path.lstrip('/'))
+    else:
+        headers["x-sendfile"] = os.path.abspath(path)
+    return Response(media_type=media_type or 'application/octet-stream', headers=headers)
+
+
+async def download_response(request: Request, path: str, media_type: str, etag: str, cache_control: str,
+                            filename: Optional[str] = None):
+    if config.file_delivery_mode == 'direct':
+        return await file_response(request, path, media_type, etag, cache_control, filename)
+    return offload_response(path, media_type, cache_control, filename)
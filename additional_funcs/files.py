@@ -1,46 +1,224 @@
-from preview_generator.manager import PreviewManager
-from fastapi import HTTPException
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from bson import ObjectId
-from shutil import move, rmtree
+from bson.errors import InvalidId
+from pydantic import BaseModel
+from pymongo import ReturnDocument
+import asyncio
+import base64
+import binascii
+import datetime
+import hashlib
+import os
 
 import config
+from additional_funcs import previews as previews_additional_funcs
 
 
-async def create_preview(path_to_file):
+def write_chunk(doc, sha256, chunk: bytes):
+    sha256.update(chunk)
+    doc.write(chunk)
+
+
+async def save_upload_file(file: UploadFile, file_object_id: ObjectId, max_size: int):
+    os.makedirs(config.upload_tmp_path, exist_ok=True)
+    tmp_path = f'{config.upload_tmp_path}/{file_object_id}.part'
+    sha256 = hashlib.sha256()
+    size = 0
+    doc = await run_in_threadpool(open, tmp_path, 'wb')
     try:
-        save_path_aka_object_id = str(ObjectId())
-        manager = PreviewManager(save_path_aka_object_id, create_folder=True)
-        path_to_preview_image = manager.get_jpeg_preview(path_to_file, page=0, height=1920, width=1920)
-        new_path_to_preview_image_name = \
-            rf'{save_path_aka_object_id}.{path_to_preview_image.split("/")[-1].split(".")[-1]}'
-        move(path_to_preview_image, config.full_save_preview_file_path + '/' + new_path_to_preview_image_name)
-        rmtree(save_path_aka_object_id, ignore_errors=True)
-        return f'cache/{new_path_to_preview_image_name}', save_path_aka_object_id
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=500, detail='Could not make a preview')
-
-
-async def delete_object_ids_from_list(the_lists: list):
-    for elem_id in range(len(the_lists)):
-        if isinstance(the_lists[elem_id], ObjectId):
-            the_lists[elem_id] = str(the_lists[elem_id])
-        elif isinstance(the_lists[elem_id], dict):
-            the_lists[elem_id] = await delete_object_ids_from_dict(the_lists[elem_id])
-        elif isinstance(the_lists[elem_id], list):
-            the_lists[elem_id] = await delete_object_ids_from_list(the_lists[elem_id])
-    return the_lists
-
-
-async def delete_object_ids_from_dict(the_dict: dict):
-    for elem in the_dict.keys():
-        if isinstance(the_dict[elem], ObjectId):
-            the_dict[elem] = str(the_dict[elem])
-        elif isinstance(the_dict[elem], dict):
-            the_dict[elem] = await delete_object_ids_from_dict(the_dict[elem])
-        elif isinstance(the_dict[elem], list):
-            the_dict[elem] = await delete_object_ids_from_list(the_dict[elem])
-    return the_dict
+        while True:
+            chunk = await file.read(config.upload_chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(status_code=413, detail='File is too large')
+            await run_in_threadpool(write_chunk, doc, sha256, chunk)
+        await run_in_threadpool(doc.close)
+    except BaseException:
+        doc.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, size, sha256.hexdigest()
+
+
+async def commit_upload_blob(tmp_path: str, sha256: str, extension: str, size: int):
+    # every generation of a blob gets its own path, so a blob removed by the last delete
+    # can not take a file re-uploaded in the meantime with it
+    path = f'{config.blobs_path}/{sha256}_{ObjectId()}.{extension}'
+    blob = await config.db.blobs.find_one_and_update(
+        {"_id": sha256},
+        {"$inc": {"ref_count": 1},
+         "$setOnInsert": {"path": path,
+                          "size": size,
+                          "preview_path": None,
+                          "preview_status": 'pending'}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    # the path tells if this upload inserted the blob, a count of 1 may also be a blob revived
+    # after a concurrent delete took it to 0, which keeps its file and preview
+    is_new = blob['path'] == path
+    if is_new:
+        os.makedirs(config.blobs_path, exist_ok=True)
+        await run_in_threadpool(os.replace, tmp_path, blob['path'])
+    else:
+        await run_in_threadpool(os.remove, tmp_path)
+    return blob, is_new
+
+
+def get_uploaded_file_info(file_object_id: ObjectId, file: UploadFile, blob: dict, size: int, sha256: str,
+                           user_id: str, company_id: str, empty_info: dict):
+    info_dict = {
+            "_id": file_object_id,
+            "name": file.filename,
+            "path": blob['path'],
+            "content_type": file.content_type,
+            "size": size,
+            "sha256": sha256,
+            "preview_path": blob['preview_path'],
+            "preview_status": blob['preview_status'],
+            "upload_date": (datetime.datetime.now()).strftime("%d.%m.%Y %H:%M:%S"),
+            "uploaded_by": ObjectId(user_id),
+            "company_id": ObjectId(company_id),
+            "recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')
+    }
+    info_dict.update(empty_info)
+    return info_dict
+
+
+async def store_batch_file(file: UploadFile, max_size: int, semaphore: asyncio.Semaphore):
+    """
+    Streams one file of a batch to its blob. A file that can not be stored gets its error instead
+    """
+    async with semaphore:
+        file_object_id = ObjectId()
+        try:
+            tmp_path, size, sha256 = await save_upload_file(file, file_object_id, max_size)
+        except HTTPException as e:
+            return dict(name=file.filename, status='failed', detail=e.detail)
+        blob, is_new_blob = await commit_upload_blob(tmp_path, sha256, file.filename.split(".")[-1], size)
+        return dict(name=file.filename, status='uploaded', file_object_id=file_object_id, blob=blob,
+                    is_new_blob=is_new_blob, size=size, sha256=sha256)
+
+
+def remove_stored_files(*paths):
+    for path in paths:
+        if path is None:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError as e:
+            print(e)
+
+
+async def release_file_blob(file: dict):
+    if file.get('sha256') is None:
+        await run_in_threadpool(remove_stored_files, file['path'])
+        await previews_additional_funcs.remove_previews(file['preview_path'], str(file['_id']))
+        return None
+    blob = await config.db.blobs.find_one_and_update({"_id": file['sha256']}, {"$inc": {"ref_count": -1}},
+                                                     return_document=ReturnDocument.AFTER)
+    if blob is not None and blob['ref_count'] <= 0:
+        deleted = await config.db.blobs.delete_one({"_id": file['sha256'], "ref_count": {"$lte": 0}})
+        if deleted.deleted_count == 1:
+            await run_in_threadpool(remove_stored_files, blob['path'])
+            await previews_additional_funcs.remove_previews(blob['preview_path'], file['sha256'])
+
+
+async def release_file_blobs(files: list):
+    """
+    release_file_blob for many files. Every blob is changed once and the stored files are removed in one thread
+    """
+    ref_counts = dict()
+    for file in files:
+        if file.get('sha256') is not None:
+            ref_counts[file['sha256']] = ref_counts.get(file['sha256'], 0) + 1
+    blobs = await asyncio.gather(*[config.db.blobs.find_one_and_update({"_id": sha256},
+                                                                       {"$inc": {"ref_count": -ref_count}},
+                                                                       return_document=ReturnDocument.AFTER)
+                                   for sha256, ref_count in ref_counts.items()])
+    unused_blobs = [blob for blob in blobs if blob is not None and blob['ref_count'] <= 0]
+    deleted = await asyncio.gather(*[config.db.blobs.delete_one({"_id": blob['_id'], "ref_count": {"$lte": 0}})
+                                     for blob in unused_blobs])
+    unused_blobs = [blob for blob, result in zip(unused_blobs, deleted) if result.deleted_count == 1]
+    # files stored before blobs have their own path and preview
+    files_without_blob = [file for file in files if file.get('sha256') is None]
+    await run_in_threadpool(remove_stored_files, *[file['path'] for file in files_without_blob],
+                            *[blob['path'] for blob in unused_blobs])
+    await asyncio.gather(*[previews_additional_funcs.remove_previews(file['preview_path'], str(file['_id']))
+                           for file in files_without_blob],
+                         *[previews_additional_funcs.remove_previews(blob['preview_path'], blob['_id'])
+                           for blob in unused_blobs])
+
+
+def encode_cursor(last_id: ObjectId):
+    return base64.urlsafe_b64encode(last_id.binary).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, InvalidId, ValueError):
+        raise HTTPException(status_code=400, detail='Not valid cursor')
+
+
+async def aggregate_file_listing(company_stages: list, files_match: dict, limit: int):
+    """
+    Gets the company with its listed part and the files grouped by folder and doc type in one round trip.
+    Files are paged by _id, one more file than the limit is read to know if there is a next page
+    """
+    listed_file = {key: '$' + key for key in config.content_to_response}
+    company = await config.db.companies.aggregate(company_stages + [
+        {"$lookup": {"from": "files",
+                     "pipeline": [{"$match": files_match},
+                                  {"$sort": {"_id": 1}},
+                                  {"$limit": limit + 1},
+                                  {"$group": {"_id": {"third_party_folder_id": "$third_party_folder_id",
+                                                      "doc_type_id": "$doc_type_id"},
+                                              "files": {"$push": listed_file}}}],
+                     "as": "file_groups"}}]).to_list(length=1)
+    return company[0] if len(company) != 0 else None
+
+
+def cut_file_page(file_groups: list, limit: int):
+    if sum(len(group['files']) for group in file_groups) <= limit:
+        return file_groups, None
+    # files of a group are sorted by _id, the extra file is the last one of some group
+    max(file_groups, key=lambda elem: elem['files'][-1]['_id'])['files'].pop()
+    file_groups = [group for group in file_groups if len(group['files']) != 0]
+    return file_groups, encode_cursor(max(group['files'][-1]['_id'] for group in file_groups))
+
+
+def get_empty_listing():
+    return dict(without_doc_type=list(), with_doc_type=dict())
+
+
+def group_files_by_folder(file_groups: list, doc_type_names: dict):
+    listings = dict()
+    # doc types are listed in the order of their first file
+    for group in sorted(file_groups, key=lambda elem: elem['files'][0]['_id']):
+        listing = listings.setdefault(group['_id'].get('third_party_folder_id'), get_empty_listing())
+        doc_type_id = group['_id'].get('doc_type_id')
+        if doc_type_id is None:
+            listing['without_doc_type'].extend(group['files'])
+        else:
+            listing['with_doc_type'][str(doc_type_id)] = dict(name=doc_type_names.get(str(doc_type_id)),
+                                                              files=group['files'])
+    return listings
+
+
+async def get_file_info_update(data: BaseModel):
+    # fields that are not sent are kept, delete_<field> sets the field to None
+    item_updated = dict()
+    for elem in data:
+        if elem[0] != 'file_id' and elem[1] is not None and elem[0][:6] != 'delete':
+            item_updated[str(elem[0])] = elem[1]
+        elif elem[0][:6] == 'delete' and elem[1]:
+            item_updated[str(elem[0][7:])] = elem[1]
+    item_updated = await fill_in_object_ids_dict(item_updated)
+    item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
+    return item_updated
 
 
 async def fill_in_object_ids_list(the_list: list):
@@ -67,48 +245,78 @@ async def fill_in_object_ids_dict(the_dict: dict):
     return the_dict
 
 
-async def check_if_ids_are_connected_to_the_company(the_tuple: tuple, company_id: str, base_file_id: str):
-    if the_tuple[0] == 'parent_id' and the_tuple[1] != base_file_id:
-        obj = config.db.files.find_one({"_id": ObjectId(the_tuple[1])})
-        if obj is not None and str(obj['company_id']) == company_id \
-                and (obj['parent_id'] is None or str(obj['parent_id']) != base_file_id):
-            return True
-    elif the_tuple[0] == 'available_signer_id':
-        obj = config.db.companies.find_one({"_id": ObjectId(company_id),
-                                            "available_signers.available_signer_id": ObjectId(the_tuple[1])})
-        if obj is not None:
-            return True
-    elif the_tuple[0] == 'division_id':
-        obj = config.db.companies.find_one({"_id": ObjectId(company_id),
-                                            "divisions.division_id": ObjectId(the_tuple[1])})
-        if obj is not None:
-            return True
-    elif the_tuple[0] == 'third_party_id':
-        obj = config.db.companies.find_one({"_id": ObjectId(company_id),
-                                            "third_parties.third_party_id": ObjectId(the_tuple[1])})
-        if obj is not None:
-            return True
-
-    elif the_tuple[0] == 'third_party_folder_id':
-        obj = list(config.db.companies.aggregate(
-                [{"$unwind": "$third_parties"},
-                 {"$unwind": "$third_parties.folders"},
-                 {"$match": {"third_parties.folders.third_party_folder_id": ObjectId(the_tuple[1])}}]))
-        if len(obj) != 0:
-            return True
-
-    elif the_tuple[0] == 'doc_type_id':
-        obj = config.db.companies.find_one({"_id": ObjectId(company_id),
-                                            "doc_types.doc_type_id": ObjectId(the_tuple[1])})
-        if obj is not None:
-            return True
-
-    raise HTTPException(status_code=400, detail='one of the ids was not found in db')
-
-
-async def search_for_parents(parent_file_id: str, history_list: list):
-    obj = config.db.files.find_one({'_id': ObjectId(parent_file_id)})
-    if obj is not None:
-        history_list.append(obj)
-        return await search_for_parents(obj['parent_id'], history_list)
-    return history_list
+def get_version_lookup(company_id: ObjectId, start_with: str, connect_from: str, connect_to: str, name: str):
+    # files already visited are not followed again, so a parent_id cycle can not loop
+    return {"$graphLookup": {"from": "files",
+                             "startWith": start_with,
+                             "connectFromField": connect_from,
+                             "connectToField": connect_to,
+                             "as": name,
+                             "maxDepth": config.file_history_max_depth,
+                             "depthField": "depth",
+                             "restrictSearchWithMatch": {"company_id": company_id}}}
+
+
+def get_version_projection(names: tuple):
+    projection = {key: 1 for key in config.content_to_response}
+    for name in names:
+        projection.update({f'{name}.{key}': 1 for key in config.content_to_response + ['parent_id', 'depth']})
+    return projection
+
+
+async def get_file_history(file_id: str, company_id: str):
+    """
+    The file followed by its parents, the nearest first. One aggregation walks the parent_id chain
+    """
+    files = await config.db.files.aggregate([
+        {"$match": {"_id": ObjectId(file_id), "company_id": ObjectId(company_id)}},
+        get_version_lookup(ObjectId(company_id), '$parent_id', 'parent_id', '_id', 'ancestors'),
+        {"$project": get_version_projection(('ancestors',))}]).to_list(length=1)
+    if len(files) == 0:
+        return None
+    file = files[0]
+    # in a parent_id cycle the file is one of its own parents
+    ancestors = sorted([elem for elem in file.pop('ancestors') if elem['_id'] != file['_id']],
+                       key=lambda elem: elem['depth'])
+    for ancestor in ancestors:
+        del ancestor['depth']
+        ancestor.pop('parent_id', None)
+    return [file] + ancestors
+
+
+async def get_file_tree(file_id: str, company_id: str):
+    """
+    Every version of the file as a tree, from the first version down through the children.
+    The root is the farthest parent, its descendants are read in the same aggregation
+    """
+    files = await config.db.files.aggregate([
+        {"$match": {"_id": ObjectId(file_id), "company_id": ObjectId(company_id)}},
+        get_version_lookup(ObjectId(company_id), '$parent_id', 'parent_id', '_id', 'ancestors'),
+        {"$unwind": {"path": "$ancestors", "preserveNullAndEmptyArrays": True}},
+        {"$sort": {"ancestors.depth": -1}},
+        {"$limit": 1},
+        {"$addFields": {"root_id": {"$ifNull": ["$ancestors._id", "$_id"]}}},
+        get_version_lookup(ObjectId(company_id), '$root_id', '_id', 'parent_id', 'descendants'),
+        {"$project": get_version_projection(('ancestors', 'descendants'))}]).to_list(length=1)
+    if len(files) == 0:
+        return None
+    file = files[0]
+    root = file.pop('ancestors', None) or file
+    return build_file_tree(root, file['descendants'])
+
+
+def build_file_tree(root: dict, descendants: list):
+    nodes = {root['_id']: root}
+    root['children'] = list()
+    # a parent is one level above its children, so it is in nodes before them
+    for elem in sorted(descendants, key=lambda elem: (elem['depth'], elem['_id'])):
+        parent = nodes.get(elem.get('parent_id'))
+        if parent is None or elem['_id'] in nodes:
+            continue
+        elem['children'] = list()
+        parent['children'].append(elem)
+        nodes[elem['_id']] = elem
+    for elem in nodes.values():
+        for key in ('parent_id', 'depth', 'descendants'):
+            elem.pop(key, None)
+    return root
@@ -0,0 +1,130 @@
+import asyncio
+import datetime
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+
+import config
+
+
+# every version lists the indexes it adds, the last applied version is kept in the schema_versions collection.
+# new indexes go to a new version, so databases that are already set up get them on the next start
+index_versions = [
+    {
+        "users": [IndexModel([("email", ASCENDING)]),
+                  IndexModel([("phone", ASCENDING)]),
+                  IndexModel([("login_info._id", ASCENDING)]),
+                  IndexModel([("company_id", ASCENDING)]),
+                  IndexModel([("division_id", ASCENDING)]),
+                  IndexModel([("role_id", ASCENDING)])],
+        "files": [IndexModel([("company_id", ASCENDING), ("third_party_id", ASCENDING), ("_id", ASCENDING)]),
+                  IndexModel([("company_id", ASCENDING), ("third_party_folder_id", ASCENDING), ("_id", ASCENDING)]),
+                  IndexModel([("company_id", ASCENDING), ("division_id", ASCENDING)]),
+                  IndexModel([("company_id", ASCENDING), ("available_signer_id", ASCENDING)]),
+                  IndexModel([("parent_id", ASCENDING)]),
+                  IndexModel([("sha256", ASCENDING)])],
+        "companies": [IndexModel([("third_parties.third_party_id", ASCENDING)]),
+                      IndexModel([("third_parties.folders.third_party_folder_id", ASCENDING)]),
+                      IndexModel([("divisions.division_id", ASCENDING)]),
+                      IndexModel([("doc_types.doc_type_id", ASCENDING)])],
+        "role_index": [IndexModel([("company_id", ASCENDING)])],
+        "preview_cache": [IndexModel([("last_access", ASCENDING)]),
+                          IndexModel([("hits", ASCENDING), ("last_access", ASCENDING)])],
+    },
+    {
+        "jobs": [IndexModel([("status", ASCENDING), ("run_after", ASCENDING)]),
+                 IndexModel([("status", ASCENDING), ("locked_until", ASCENDING)]),
+                 IndexModel([("company_id", ASCENDING), ("kind", ASCENDING), ("status", ASCENDING)])],
+    },
+]
+
+
+def get_query_shapes():
+    """
+    Filters of the queries the routes run, with placeholder values. Each of them has to be served by an index
+    """
+    some_id = ObjectId()
+    return [
+        ("users", {"email": ''}, None),
+        ("users", {"phone": ''}, None),
+        ("users", {"login_info._id": some_id}, None),
+        ("users", {"company_id": some_id}, None),
+        ("users", {"company_id": some_id, "role_id": some_id}, None),
+        ("users", {"company_id": some_id, "division_id": some_id}, None),
+        ("files", {"company_id": some_id}, None),
+        ("files", {"company_id": some_id, "third_party_id": some_id, "_id": {"$gt": some_id}}, {"_id": 1}),
+        ("files", {"company_id": some_id, "third_party_folder_id": some_id, "_id": {"$gt": some_id}}, {"_id": 1}),
+        ("files", {"company_id": some_id, "division_id": some_id}, None),
+        ("files", {"company_id": some_id, "available_signer_id": some_id}, None),
+        ("files", {"parent_id": some_id}, None),
+        # the version tree walks parent_id within the company, with $graphLookup
+        ("files", {"parent_id": some_id, "company_id": some_id}, None),
+        ("files", {"sha256": ''}, None),
+        ("companies", {"third_parties.third_party_id": some_id}, None),
+        ("companies", {"third_parties.folders.third_party_folder_id": some_id}, None),
+        ("companies", {"divisions.division_id": some_id}, None),
+        ("companies", {"doc_types.doc_type_id": some_id}, None),
+        ("role_index", {"company_id": some_id}, None),
+        ("jobs", {"status": 'pending', "run_after": {"$lte": datetime.datetime.now()}}, None),
+        ("jobs", {"status": 'running', "locked_until": {"$lt": datetime.datetime.now()}}, None),
+        ("jobs", {"company_id": some_id, "kind": '', "status": {"$in": ['pending', 'running', 'failed']}}, None),
+        ("jobs", {"company_id": some_id, "kind": '', "created_by": some_id, "status": 'failed'}, None),
+    ]
+
+
+async def apply_indexes():
+    state = await config.db.schema_versions.find_one({"_id": "indexes"})
+    current_version = state['version'] if state is not None else 0
+    applied = list()
+    for version, collections in enumerate(index_versions, start=1):
+        if version <= current_version:
+            continue
+        for collection, indexes in collections.items():
+            await config.db[collection].create_indexes(indexes)
+        await config.db.schema_versions.update_one({"_id": "indexes"},
+                                                   {"$max": {"version": version},
+                                                    "$set": {"applied_at": datetime.datetime.now()}},
+                                                   upsert=True)
+        applied.append(version)
+    return applied
+
+
+def find_stages(plan, stages: set):
+    if isinstance(plan, dict):
+        if plan.get('stage') is not None:
+            stages.add(plan['stage'])
+        for value in plan.values():
+            find_stages(value, stages)
+    elif isinstance(plan, list):
+        for value in plan:
+            find_stages(value, stages)
+    return stages
+
+
+async def check_query_shapes():
+    collection_scans = list()
+    for collection, query_filter, sort in get_query_shapes():
+        command = {"find": collection, "filter": query_filter}
+        if sort is not None:
+            command["sort"] = sort
+        explained = await config.db.command("explain", command, verbosity="queryPlanner")
+        if 'COLLSCAN' in find_stages(explained['queryPlanner']['winningPlan'], set()):
+            collection_scans.append(f'{collection} {query_filter}')
+    if len(collection_scans) != 0:
+        raise RuntimeError('queries without an index: ' + '; '.join(collection_scans))
+
+
+async def main(command: str):
+    if command == 'apply':
+        print('applied index versions:', await apply_indexes())
+    elif command == 'check':
+        await check_query_shapes()
+        print('every query shape is served by an index')
+    else:
+        raise ValueError(f'Unknown command {command}, use apply or check')
+
+
+if __name__ == "__main__":
+    # python -m additional_funcs.indexes apply|check
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else 'apply'))
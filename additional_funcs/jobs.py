@@ -0,0 +1,145 @@
+import asyncio
+import datetime
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+import config
+
+
+# kind -> async function(job) that does the work, registered with job_handler
+handlers = dict()
+worker_task = None
+wake_up: Optional[asyncio.Event] = None
+
+
+def job_handler(kind: str):
+    def register(func):
+        handlers[kind] = func
+        return func
+    return register
+
+
+async def enqueue(kind: str, company_id, created_by, params: Optional[dict] = None):
+    """
+    Stores a job in the jobs collection, the worker of any app process can run it.
+    A job that was cut off (restart, crash) is run again once its lease runs out, so handlers
+    have to be safe to run again from where they stopped
+    """
+    now = datetime.datetime.now()
+    job = {"_id": ObjectId(),
+           "kind": kind,
+           "company_id": ObjectId(company_id) if company_id is not None else None,
+           "created_by": ObjectId(created_by) if created_by is not None else None,
+           "params": params or dict(),
+           "status": 'pending',
+           "attempts": 0,
+           "progress": dict(),
+           "error": None,
+           "run_after": now,
+           "locked_until": None,
+           "created_at": now,
+           "updated_at": now}
+    await config.db.jobs.insert_one(job)
+    if wake_up is not None:
+        wake_up.set()
+    return job
+
+
+async def requeue_failed_job(job_filter: dict):
+    """
+    Puts the latest job of job_filter that failed for good back in the queue with fresh attempts
+    """
+    now = datetime.datetime.now()
+    job = await config.db.jobs.find_one_and_update({**job_filter, "status": 'failed'},
+                                                   {"$set": {"status": 'pending',
+                                                             "attempts": 0,
+                                                             "error": None,
+                                                             "run_after": now,
+                                                             "locked_until": None,
+                                                             "updated_at": now}},
+                                                   sort=[("created_at", -1)], return_document=ReturnDocument.AFTER)
+    if job is not None and wake_up is not None:
+        wake_up.set()
+    return job
+
+
+def get_job_view(job: dict):
+    return {key: job.get(key) for key in ('_id', 'kind', 'params', 'status', 'attempts', 'progress', 'error',
+                                          'created_at', 'updated_at')}
+
+
+async def claim_job():
+    now = datetime.datetime.now()
+    return await config.db.jobs.find_one_and_update(
+        {"$or": [{"status": 'pending', "run_after": {"$lte": now}},
+                 {"status": 'running', "locked_until": {"$lt": now}}]},
+        {"$set": {"status": 'running',
+                  "locked_until": now + datetime.timedelta(seconds=config.job_lease_seconds),
+                  "updated_at": now},
+         "$inc": {"attempts": 1}},
+        sort=[("run_after", 1)], return_document=ReturnDocument.AFTER)
+
+
+async def update_progress(job: dict, **progress):
+    # a job that reports progress keeps its lease, so no other worker takes it over
+    now = datetime.datetime.now()
+    await config.db.jobs.update_one({"_id": job['_id']},
+                                    {"$set": {**{f'progress.{key}': value for key, value in progress.items()},
+                                              "locked_until": now + datetime.timedelta(
+                                                  seconds=config.job_lease_seconds),
+                                              "updated_at": now}})
+    job['progress'].update(progress)
+
+
+async def run_job(job: dict):
+    try:
+        handler = handlers.get(job['kind'])
+        if handler is None:
+            raise RuntimeError(f"Unknown job kind {job['kind']}")
+        await handler(job)
+    except Exception as e:
+        print(e)
+        now = datetime.datetime.now()
+        if job['attempts'] >= config.job_max_attempts:
+            update = {"status": 'failed'}
+        else:
+            delay = config.job_retry_delay * 2 ** (job['attempts'] - 1)
+            update = {"status": 'pending', "run_after": now + datetime.timedelta(seconds=delay)}
+        update.update(error=str(e), locked_until=None, updated_at=now)
+        await config.db.jobs.update_one({"_id": job['_id']}, {"$set": update})
+        return None
+    await config.db.jobs.update_one({"_id": job['_id']},
+                                    {"$set": {"status": 'done', "error": None, "locked_until": None,
+                                              "updated_at": datetime.datetime.now()}})
+
+
+async def work_forever():
+    while True:
+        wake_up.clear()
+        try:
+            job = await claim_job()
+            if job is not None:
+                await run_job(job)
+                continue
+        except Exception as e:
+            print(e)
+        try:
+            await asyncio.wait_for(wake_up.wait(), timeout=config.job_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_worker():
+    global worker_task, wake_up
+    if worker_task is None:
+        wake_up = asyncio.Event()
+        worker_task = asyncio.create_task(work_forever())
+
+
+async def stop_worker():
+    global worker_task
+    if worker_task is not None:
+        worker_task.cancel()
+        worker_task = None
@@ -0,0 +1,122 @@
+import asyncio
+import datetime
+import os
+import re
+
+from fastapi.concurrency import run_in_threadpool
+from pymongo import UpdateOne
+
+import config
+
+
+# accesses are collected in memory and written to the preview_cache collection by the sweeper
+pending_accesses = dict()
+sweeper_task = None
+
+
+def get_file_size(path: str):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+
+
+async def register(path: str):
+    size = await run_in_threadpool(get_file_size, path)
+    if size is None:
+        return None
+    await config.db.preview_cache.update_one({"_id": path},
+                                             {"$set": {"size": size, "last_access": datetime.datetime.now()},
+                                              "$setOnInsert": {"hits": 0}},
+                                             upsert=True)
+
+
+def touch(path: str):
+    access = pending_accesses.setdefault(path, [None, 0])
+    access[0] = datetime.datetime.now()
+    access[1] += 1
+
+
+async def unregister(*paths: str):
+    paths = [path for path in paths if path is not None]
+    if len(paths) != 0:
+        await config.db.preview_cache.delete_many({"_id": {"$in": paths}})
+
+
+async def unregister_prefix(prefix: str):
+    await config.db.preview_cache.delete_many({"_id": {"$regex": '^' + re.escape(prefix)}})
+
+
+def get_file_sizes(paths: list):
+    return {path: get_file_size(path) for path in paths}
+
+
+async def flush_accesses():
+    global pending_accesses
+    if len(pending_accesses) == 0:
+        return None
+    accesses, pending_accesses = pending_accesses, dict()
+    # previews written before they were tracked get registered on their first access
+    sizes = await run_in_threadpool(get_file_sizes, list(accesses))
+    requests = [UpdateOne({"_id": path},
+                          {"$max": {"last_access": last_access},
+                           "$inc": {"hits": hits},
+                           "$set": {"size": sizes[path]}}, upsert=True)
+                for path, (last_access, hits) in accesses.items() if sizes[path] is not None]
+    if len(requests) != 0:
+        await config.db.preview_cache.bulk_write(requests, ordered=False)
+
+
+def remove_cached_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError as e:
+        print(e)
+
+
+async def enforce_budget():
+    total = await config.db.preview_cache.aggregate(
+        [{"$group": {"_id": None, "size": {"$sum": "$size"}}}]).to_list(length=1)
+    total = total[0]['size'] if len(total) != 0 else 0
+    if total <= config.preview_cache_max_bytes:
+        return 0
+    target = config.preview_cache_max_bytes * config.preview_cache_low_watermark
+    if config.preview_cache_policy == 'lfu':
+        order = [("hits", 1), ("last_access", 1)]
+    else:
+        order = [("last_access", 1)]
+    evicted = 0
+    async for entry in config.db.preview_cache.find({}, {"size": 1}).sort(order):
+        if total <= target:
+            break
+        # several workers may sweep at once, only the one that deletes the entry removes the file
+        deleted = await config.db.preview_cache.delete_one({"_id": entry["_id"]})
+        if deleted.deleted_count == 1:
+            await run_in_threadpool(remove_cached_file, entry["_id"])
+            total -= entry["size"]
+            evicted += 1
+    return evicted
+
+
+async def sweep_forever():
+    while True:
+        try:
+            await flush_accesses()
+            await enforce_budget()
+        except Exception as e:
+            print(e)
+        await asyncio.sleep(config.preview_cache_sweep_interval)
+
+
+def start_sweeper():
+    global sweeper_task
+    if sweeper_task is None:
+        sweeper_task = asyncio.create_task(sweep_forever())
+
+
+async def stop_sweeper():
+    global sweeper_task
+    if sweeper_task is not None:
+        sweeper_task.cancel()
+        sweeper_task = None
+    await flush_accesses()
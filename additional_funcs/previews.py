@@ -0,0 +1,256 @@
+import asyncio
+import datetime
+import glob
+import mimetypes
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from shutil import move, rmtree
+from typing import Optional
+
+from bson import ObjectId
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image
+from preview_generator.manager import PreviewManager
+
+import config
+from additional_funcs import preview_cache
+
+
+class PreviewJobTimeout(Exception):
+    pass
+
+
+class PreviewQueueFull(Exception):
+    pass
+
+
+executor: Optional[ProcessPoolExecutor] = None
+# one slot per worker process, a job holds one while it runs in the pool
+worker_slots: Optional[asyncio.Semaphore] = None
+queued_jobs = 0
+background_tasks = set()
+render_jobs = dict()
+
+
+def raise_preview_job_timeout(signum, frame):
+    raise PreviewJobTimeout('preview job took too long')
+
+
+@contextmanager
+def job_alarm(timeout: int):
+    # runs in a worker process, the alarm frees the worker if the converter hangs (not available on windows)
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, raise_preview_job_timeout)
+        signal.alarm(timeout)
+    try:
+        yield
+    finally:
+        if hasattr(signal, 'SIGALRM'):
+            signal.alarm(0)
+
+
+def render_preview(path_to_file: str, save_preview_file_path: str, timeout: int,
+                   preview_name: Optional[str] = None):
+    save_path_aka_object_id = str(ObjectId())
+    try:
+        with job_alarm(timeout):
+            manager = PreviewManager(save_path_aka_object_id, create_folder=True)
+            path_to_preview_image = manager.get_jpeg_preview(path_to_file, page=0, height=1920, width=1920)
+            new_path_to_preview_image_name = preview_name or \
+                rf'{save_path_aka_object_id}.{path_to_preview_image.split("/")[-1].split(".")[-1]}'
+            move(path_to_preview_image, save_preview_file_path + '/' + new_path_to_preview_image_name)
+        return f'cache/{new_path_to_preview_image_name}'
+    finally:
+        rmtree(save_path_aka_object_id, ignore_errors=True)
+
+
+def render_preview_variant(path_to_file: str, page: int, size: int, image_format: str, variant_path: str,
+                           timeout: int):
+    save_path_aka_object_id = str(ObjectId())
+    tmp_variant_path = f'{variant_path}.{save_path_aka_object_id}.part'
+    try:
+        with job_alarm(timeout):
+            manager = PreviewManager(save_path_aka_object_id, create_folder=True)
+            path_to_preview_image = manager.get_jpeg_preview(path_to_file, page=page, height=size, width=size)
+            if image_format == 'webp':
+                with Image.open(path_to_preview_image) as image:
+                    image.save(tmp_variant_path, 'WEBP', quality=config.preview_variant_quality)
+            else:
+                move(path_to_preview_image, tmp_variant_path)
+            os.replace(tmp_variant_path, variant_path)
+        return variant_path
+    finally:
+        rmtree(save_path_aka_object_id, ignore_errors=True)
+        if os.path.exists(tmp_variant_path):
+            os.remove(tmp_variant_path)
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=config.preview_workers)
+    return executor
+
+
+def get_worker_slots():
+    global worker_slots
+    if worker_slots is None:
+        worker_slots = asyncio.Semaphore(config.preview_workers)
+    return worker_slots
+
+
+async def run_preview_job(func, *args):
+    global queued_jobs
+    if queued_jobs >= config.preview_queue_size:
+        raise PreviewQueueFull('preview queue is full')
+    queued_jobs += 1
+    try:
+        # the timeout starts once a worker is free, time spent waiting in the queue does not count
+        async with get_worker_slots():
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(loop.run_in_executor(get_executor(), func, *args),
+                                          timeout=config.preview_job_timeout)
+    finally:
+        queued_jobs -= 1
+
+
+async def run_preview_job_when_queued(func, *args):
+    # a full queue is not a failed render, the job waits for space in the queue
+    while True:
+        try:
+            return await run_preview_job(func, *args)
+        except PreviewQueueFull as e:
+            print(e)
+            await asyncio.sleep(config.preview_queue_retry_delay)
+
+
+async def generate_preview(sha256: str, path_to_file: str):
+    try:
+        preview_path = await run_preview_job_when_queued(render_preview, path_to_file,
+                                                         config.full_save_preview_file_path,
+                                                         config.preview_job_timeout)
+        preview_status = 'ready'
+        await preview_cache.register(get_preview_disk_path(preview_path))
+    except Exception as e:
+        print(e)
+        preview_path = None
+        preview_status = 'failed'
+    preview = {"preview_path": preview_path, "preview_status": preview_status}
+    # the blob goes first, files inserted after this point copy the preview from it
+    await config.db.blobs.update_one({"_id": sha256}, {"$set": preview})
+    preview["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
+    await config.db.files.update_many({"sha256": sha256}, {"$set": preview})
+
+
+async def sync_file_preview(file_id: ObjectId, sha256: str):
+    blob = await config.db.blobs.find_one({"_id": sha256}, {"preview_path": 1, "preview_status": 1})
+    if blob is not None and blob['preview_status'] != 'pending':
+        await config.db.files.update_one({"_id": file_id},
+                                         {"$set": {"preview_path": blob['preview_path'],
+                                                   "preview_status": blob['preview_status'],
+                                                   "recent_change":
+                                                       str(datetime.datetime.now().timestamp()).replace('.', '')}})
+
+
+async def generate_previews(blobs: list):
+    # a batch keeps at most one job per worker in the queue, so single uploads still get their previews queued
+    semaphore = asyncio.Semaphore(config.preview_workers)
+
+    async def generate_one(sha256: str, path_to_file: str):
+        async with semaphore:
+            await generate_preview(sha256, path_to_file)
+
+    await asyncio.gather(*[generate_one(sha256, path_to_file) for sha256, path_to_file in blobs])
+
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    # the loop keeps only weak references to tasks
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def schedule_preview(sha256: str, path_to_file: str):
+    return run_in_background(generate_preview(sha256, path_to_file))
+
+
+def schedule_previews(blobs: list):
+    """
+    Renders the previews of (sha256, path) pairs concurrently, as many at a time as there are workers
+    """
+    return run_in_background(generate_previews(blobs))
+
+
+def get_preview_disk_path(preview_path: str):
+    return f'{config.full_save_preview_file_path}/{preview_path.split("/")[-1]}'
+
+
+def get_preview_media_type(preview_disk_path: str):
+    # the converter names previews by their extension, .jpg included
+    return mimetypes.guess_type(preview_disk_path)[0] or 'image/jpeg'
+
+
+def get_variant_path(source_key: str, page: int, size: int, image_format: str):
+    return f'{config.preview_variants_path}/{source_key}_{page}_{size}.{image_format}'
+
+
+async def render_once(disk_path: str, func, *args):
+    # concurrent requests for the same missing file wait for one render
+    job = render_jobs.get(disk_path)
+    if job is None:
+        job = asyncio.ensure_future(run_preview_job(func, *args))
+        render_jobs[disk_path] = job
+        job.add_done_callback(lambda _: render_jobs.pop(disk_path, None))
+    await asyncio.shield(job)
+    await preview_cache.register(disk_path)
+
+
+async def get_preview_file(preview_path: str, path_to_file: str):
+    disk_path = get_preview_disk_path(preview_path)
+    if await run_in_threadpool(os.path.exists, disk_path):
+        preview_cache.touch(disk_path)
+    else:
+        # evicted from the cache, rendered again under the same name
+        await render_once(disk_path, render_preview, path_to_file, config.full_save_preview_file_path,
+                          config.preview_job_timeout, disk_path.split('/')[-1])
+    return disk_path
+
+
+async def get_preview_variant(source_key: str, path_to_file: str, page: int, size: int, image_format: str):
+    variant_path = get_variant_path(source_key, page, size, image_format)
+    if await run_in_threadpool(os.path.exists, variant_path):
+        preview_cache.touch(variant_path)
+    else:
+        os.makedirs(config.preview_variants_path, exist_ok=True)
+        await render_once(variant_path, render_preview_variant, path_to_file, page, size, image_format,
+                          variant_path, config.preview_job_timeout)
+    return variant_path
+
+
+def remove_preview_files(preview_disk_path: Optional[str], source_key: str):
+    paths = glob.glob(f'{config.preview_variants_path}/{source_key}_*')
+    if preview_disk_path is not None:
+        paths.append(preview_disk_path)
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError as e:
+            print(e)
+
+
+async def remove_previews(preview_path: Optional[str], source_key: str):
+    preview_disk_path = get_preview_disk_path(preview_path) if preview_path is not None else None
+    await run_in_threadpool(remove_preview_files, preview_disk_path, source_key)
+    await preview_cache.unregister(preview_disk_path)
+    await preview_cache.unregister_prefix(f'{config.preview_variants_path}/{source_key}_')
+
+
+def shutdown():
+    global executor, worker_slots
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+    worker_slots = None
@@ -0,0 +1,78 @@
+import asyncio
+
+from bson import ObjectId
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+import config
+from middlewares import company_loader
+
+
+def get_references(data: BaseModel):
+    """
+    The ids of data that have to belong to a company, the model lists their fields in company_references
+    """
+    references = dict()
+    for name in getattr(data, 'company_references', tuple()):
+        value = getattr(data, name)
+        if value is not None:
+            references[name] = ObjectId(value)
+    return references
+
+
+def raise_invalid_references(invalid: list, location: tuple = ('body',)):
+    # same shape as the 422 fastapi sends for a body that does not parse
+    if len(invalid) != 0:
+        raise HTTPException(status_code=422, detail=[{"loc": [*location, name],
+                                                      "msg": f'{name} validation failed',
+                                                      "type": "value_error.reference"} for name in invalid])
+
+
+async def find_invalid_company_references(data: BaseModel, company_id: str):
+    references = get_references(data)
+    if len(references) == 0:
+        return list()
+    company = await company_loader.load_company(company_id)
+    if company is None:
+        return list(references)
+    return [name for name, value in references.items()
+            if value not in company_loader.get_company_ids(company, name)]
+
+
+async def find_invalid_parent(data: BaseModel, company_id: str):
+    # a parent is a file of the same company, which is not the file itself or its child
+    parent_id = getattr(data, 'parent_id', None)
+    if parent_id is None:
+        return list()
+    if parent_id == data.file_id:
+        return ['parent_id']
+    parent = await config.db.files.find_one({"_id": ObjectId(parent_id), "company_id": ObjectId(company_id)},
+                                            {"parent_id": 1})
+    if parent is None or str(parent.get('parent_id')) == data.file_id:
+        return ['parent_id']
+    return list()
+
+
+async def check_references(data: BaseModel, company_id: str, location: tuple = ('body',)):
+    """
+    Checks every id of the request against the company of the user after the body is parsed.
+    The company ids are resolved from one read of the company, all invalid ids are reported together
+    """
+    invalid_lists = await asyncio.gather(find_invalid_company_references(data, company_id),
+                                         find_invalid_parent(data, company_id))
+    raise_invalid_references([name for invalid in invalid_lists for name in invalid], location)
+
+
+async def check_signup_references(user: BaseModel):
+    """
+    A new user has no company yet, the division and the role are checked against the company of the request
+    """
+    references = get_references(user)
+    if user.company_id is None:
+        raise_invalid_references(list(references))
+        return None
+    company = await company_loader.load_company(user.company_id)
+    if company is None:
+        raise_invalid_references(['company_id'] + list(references))
+    raise_invalid_references([name for name, value in references.items()
+                              if value not in company_loader.get_company_ids(company, name)])
@@ -0,0 +1,120 @@
+import datetime
+from contextvars import ContextVar
+
+import orjson
+from bson import ObjectId, Decimal128
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+# binary formats are offered only when their packages are installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+json_media_type = 'application/json'
+msgpack_media_type = 'application/msgpack'
+cbor_media_type = 'application/cbor'
+
+accepted_media_types = {'application/json': json_media_type,
+                        'application/*': json_media_type,
+                        '*/*': json_media_type}
+if msgpack is not None:
+    accepted_media_types.update({'application/msgpack': msgpack_media_type,
+                                 'application/x-msgpack': msgpack_media_type,
+                                 'application/vnd.msgpack': msgpack_media_type})
+if cbor2 is not None:
+    accepted_media_types['application/cbor'] = cbor_media_type
+
+# set by NegotiatedRoute for the request being handled
+negotiated_media_type = ContextVar('negotiated_media_type', default=json_media_type)
+
+
+def negotiate_media_type(accept: str):
+    """
+    Picks the format with the highest q value from the Accept header, json wins ties and is the fallback
+    """
+    if not accept:
+        return json_media_type
+    choices = dict()
+    for part in accept.split(','):
+        media_type, *params = [elem.strip() for elem in part.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        choice = accepted_media_types.get(media_type.lower())
+        if choice is not None and quality > 0:
+            choices[choice] = max(choices.get(choice, 0.0), quality)
+    if len(choices) == 0:
+        return json_media_type
+    return max(choices, key=lambda elem: (choices[elem], elem == json_media_type))
+
+
+def encode_bson_types(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, BaseModel):
+        return value.dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def encode_bson_types_binary(value):
+    # binary formats carry ObjectIds as their 12 raw bytes
+    if isinstance(value, ObjectId):
+        return value.binary
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return encode_bson_types(value)
+
+
+def encode_cbor_value(encoder, value):
+    encoder.encode(encode_bson_types_binary(value))
+
+
+class MongoResponse(JSONResponse):
+    """
+    Renders documents from the db as they are, ObjectId and Decimal128 are encoded on the way.
+    The format is json (orjson), msgpack or cbor, as negotiated by NegotiatedRoute.
+    Routes return it directly, fastapi does not run jsonable_encoder over a response it gets
+    """
+    def render(self, content) -> bytes:
+        media_type = negotiated_media_type.get()
+        if media_type == msgpack_media_type:
+            self.media_type = media_type
+            return msgpack.packb(content, default=encode_bson_types_binary, use_bin_type=True)
+        if media_type == cbor_media_type:
+            self.media_type = media_type
+            # naive datetimes are sent as iso strings, like in json
+            return cbor2.dumps(content, default=encode_cbor_value,
+                               encoders={datetime.datetime: encode_cbor_value})
+        return orjson.dumps(content, default=encode_bson_types)
+
+
+class NegotiatedRoute(APIRoute):
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def negotiated_route_handler(request: Request):
+            token = negotiated_media_type.set(negotiate_media_type(request.headers.get('accept')))
+            try:
+                response = await route_handler(request)
+            finally:
+                negotiated_media_type.reset(token)
+            if isinstance(response, MongoResponse):
+                response.headers.add_vary_header('Accept')
+            return response
+
+        return negotiated_route_handler
@@ -0,0 +1,54 @@
+import datetime
+
+from bson import ObjectId, Decimal128
+
+
+converters = {
+    # same result as str(), without the python level __str__
+    ObjectId: lambda value: value.binary.hex(),
+    datetime.datetime: datetime.datetime.isoformat,
+    Decimal128: lambda value: str(value.to_decimal()),
+}
+
+
+def delete_object_ids_from_list(the_list: list):
+    for elem_id, elem in enumerate(the_list):
+        elem_type = type(elem)
+        if elem_type is dict:
+            delete_object_ids_from_dict(elem)
+        elif elem_type is list:
+            delete_object_ids_from_list(elem)
+        else:
+            converter = converters.get(elem_type)
+            if converter is not None:
+                the_list[elem_id] = converter(elem)
+    return the_list
+
+
+def delete_object_ids_from_dict(the_dict: dict):
+    for key, elem in the_dict.items():
+        elem_type = type(elem)
+        if elem_type is dict:
+            delete_object_ids_from_dict(elem)
+        elif elem_type is list:
+            delete_object_ids_from_list(elem)
+        else:
+            converter = converters.get(elem_type)
+            if converter is not None:
+                the_dict[key] = converter(elem)
+    return the_dict
+
+
+def delete_object_ids(value):
+    """
+    Converts a document in place so it can be sent as json, ObjectId and Decimal128 become strings
+    and datetime an iso string. Only nested dicts and lists are walked, other values cost one type lookup
+    """
+    value_type = type(value)
+    if value_type is dict:
+        return delete_object_ids_from_dict(value)
+    if value_type is list:
+        return delete_object_ids_from_list(value)
+    if value_type in converters:
+        return converters[value_type](value)
+    return value
@@ -1,65 +1,70 @@
+import asyncio
 from datetime import datetime, timedelta
 from typing import Optional
 from bson import ObjectId
+from fastapi import HTTPException
 from pymongo import ReturnDocument
 import config
 import middlewares.auth
+from middlewares.principal_cache import principal_cache
 
 
 async def check_if_data_is_free_for_registration(email: str, phone: str):
-    user_email_check = config.db.users.find_one({"email": email})
-    user_phone_check = config.db.users.find_one({"phone": phone})
+    user_email_check, user_phone_check = await asyncio.gather(config.db.users.find_one({"email": email}),
+                                                              config.db.users.find_one({"phone": phone}))
     if user_email_check is not None or user_phone_check is not None:
         return False
     return True
 
 
 async def check_user_email_password_in_db(email_or_phone_or_id: str, _id_check: Optional[bool] = False):
-    user_email_check = config.db.users.find_one({"email": email_or_phone_or_id})
-    user_phone_check = config.db.users.find_one({"phone": email_or_phone_or_id})
-
-    if user_email_check is not None:
-        return user_email_check
-    elif user_phone_check is not None:
-        return user_phone_check
-    elif _id_check:
-        user__id_check = config.db.users.find_one({"_id": ObjectId(email_or_phone_or_id)})
-        if user__id_check is not None:
-            return user__id_check
+    queries = [config.db.users.find_one({"email": email_or_phone_or_id}),
+               config.db.users.find_one({"phone": email_or_phone_or_id})]
+    if _id_check and ObjectId.is_valid(email_or_phone_or_id):
+        queries.append(config.db.users.find_one({"_id": ObjectId(email_or_phone_or_id)}))
+    # the lookups are independent, the first found one wins in the order email, phone, _id
+    for user_check in await asyncio.gather(*queries):
+        if user_check is not None:
+            return user_check
     return None
 
 
 async def check_user_session_in_db(session_id: str):
     if len(session_id) == 24:
-        user_obj = config.db.users.find_one({"login_info._id": ObjectId(session_id)})
+        user_obj = await config.db.users.find_one({"login_info._id": ObjectId(session_id)})
         return user_obj
     return False
 
 
-async def unset_active_session_in_db(user_id: str, session_id: str):
-    config.db.users.update_one({"_id": ObjectId(user_id),
-                                "login_info._id": ObjectId(session_id)},
-                               {'$set': {"login_info.$.is_active": False,
-                                         "recent_change": str(datetime.now().timestamp()).replace('.', '')}})
-    session = list(config.db.users.aggregate(
-                    [{"$unwind": "$login_info"},
-                     {"$match": {"login_info._id": ObjectId(session_id)}}]))
-    if len(session) > 0:
-        await middlewares.auth.revoke_token(
-            session[0]['login_info']['jti_refresh'],
-            int(str(datetime.timestamp(
-                datetime.now() + timedelta(days=config.AUTHJWT_REFRESH_TOKEN_EXPIRES.days))).split('.')[0])
-        )
-        await middlewares.auth.revoke_token(
-            session[0]['login_info']['jti_access'],
-            int(str(datetime.timestamp(
-                datetime.now() + timedelta(seconds=config.AUTHJWT_ACCESS_TOKEN_EXPIRES.seconds))).split('.')[0])
-        )
+async def unset_active_session_in_db(user_id: str, session_id: str, tokens: tuple = tuple()):
+    """
+    Closes the session and revokes its tokens together with the (jti, exp) pairs in tokens
+    """
+    recent_change = str(datetime.now().timestamp()).replace('.', '')
+    user = await config.db.users.find_one_and_update({"_id": ObjectId(user_id),
+                                                      "login_info._id": ObjectId(session_id)},
+                                                     {'$set': {"login_info.$.is_active": False,
+                                                               "recent_change": recent_change}},
+                                                     projection={"login_info": {
+                                                         "$elemMatch": {"_id": ObjectId(session_id)}}})
+    await principal_cache.user_changed(user_id, recent_change)
+    tokens = list(tokens)
+    if user is not None and len(user.get('login_info', list())) > 0:
+        session = user['login_info'][0]
+        now = datetime.now()
+        if session.get('jti_refresh') is not None:
+            tokens.append((session['jti_refresh'], int(datetime.timestamp(
+                now + timedelta(days=config.AUTHJWT_REFRESH_TOKEN_EXPIRES.days)))))
+        if session.get('jti_access') is not None:
+            tokens.append((session['jti_access'], int(datetime.timestamp(
+                now + timedelta(seconds=config.AUTHJWT_ACCESS_TOKEN_EXPIRES.seconds)))))
+    await middlewares.auth.revoke_tokens(tokens)
 
 
 async def update_last_login(current_user_id: str, user_agent_header: str):
-    active_sessions = list(config.db.users.aggregate(
+    active_sessions = await config.db.users.aggregate(
         [
+            {"$match": {"_id": ObjectId(current_user_id)}},
             {
                 "$project": {
                     "_id": ObjectId(current_user_id), "is_active":
@@ -68,12 +73,15 @@ async def update_last_login(current_user_id: str, user_agent_header: str):
                                               "cond": {
                                                   "$eq": [
                                                       "$$login.is_active",
-                                                      True]}}}}}]))[0]
+                                                      True]}}}}}]).to_list(length=1)
+    if len(active_sessions) == 0:
+        raise HTTPException(status_code=404, detail='Could not find the current_user')
+    active_sessions = active_sessions[0]
 
-    if active_sessions['is_active'] is not None and len(active_sessions['is_active']) >= 5:
+    if active_sessions.get('is_active') is not None and len(active_sessions['is_active']) >= 5:
         await unset_active_session_in_db(current_user_id, active_sessions['is_active'][0]["_id"])
 
-    elem = config.db.users.find_one_and_update(
+    elem = await config.db.users.find_one_and_update(
                     {"_id": ObjectId(current_user_id)},
                     {
                         '$push': {
@@ -86,6 +94,7 @@ async def update_last_login(current_user_id: str, user_agent_header: str):
                         '$set': {"recent_change": str(datetime.now().timestamp()).replace('.', '')}
                     }, return_document=ReturnDocument.AFTER
                 )
+    await principal_cache.user_changed(current_user_id, elem["recent_change"])
 
     return str(elem["login_info"][-1]["_id"])
 
@@ -102,29 +111,7 @@ async def insert_jti_in_session_id(user_id: str, session_id: str,
     else:
         the_dict = {"login_info.$.jti_refresh": jti_refresh}
 
-    the_dict["recent_change"] = str(datetime.now().timestamp()).replace('.', '')
-    config.db.users.update_one({"_id": ObjectId(user_id),
-                                "login_info._id": ObjectId(session_id)},
-                               {'$set': the_dict})
-
-
-async def delete_object_ids_from_list(the_lists: list):
-    for elem_id in range(len(the_lists)):
-        if isinstance(the_lists[elem_id], ObjectId):
-            the_lists[elem_id] = str(the_lists[elem_id])
-        elif isinstance(the_lists[elem_id], dict):
-            the_lists[elem_id] = await delete_object_ids_from_dict(the_lists[elem_id])
-        elif isinstance(the_lists[elem_id], list):
-            the_lists[elem_id] = await delete_object_ids_from_list(the_lists[elem_id])
-    return the_lists
-
-
-async def delete_object_ids_from_dict(the_dict: dict):
-    for elem in the_dict.keys():
-        if isinstance(the_dict[elem], ObjectId):
-            the_dict[elem] = str(the_dict[elem])
-        elif isinstance(the_dict[elem], dict):
-            the_dict[elem] = await delete_object_ids_from_dict(the_dict[elem])
-        elif isinstance(the_dict[elem], list):
-            the_dict[elem] = await delete_object_ids_from_list(the_dict[elem])
-    return the_dict
+    # the jtis are not part of the cached principal, so the user is not marked as changed
+    await config.db.users.update_one({"_id": ObjectId(user_id),
+                                      "login_info._id": ObjectId(session_id)},
+                                     {'$set': the_dict})
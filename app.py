@@ -7,8 +7,19 @@ from fastapi_jwt_auth.exceptions import AuthJWTException
 from fastapi.requests import Request
 from fastapi.responses import JSONResponse
 import config
+from additional_funcs import companies as companies_additional_funcs
+from additional_funcs import previews as previews_additional_funcs
+from additional_funcs import preview_cache
+from additional_funcs import indexes
+from additional_funcs import jobs
+from additional_funcs.responses import MongoResponse
+from middlewares import company_loader
+from middlewares.token_denylist import token_denylist
 
-app = FastAPI()
+# documents are rendered as json, msgpack or cbor by the Accept header of the request (see routers route_class),
+# routes that return a MongoResponse also skip jsonable_encoder
+app = FastAPI(default_response_class=MongoResponse)
+app.add_middleware(company_loader.CompanyLoaderMiddleware)
 
 
 app.include_router(files.router)
@@ -16,6 +27,48 @@ app.include_router(users.router)
 app.include_router(companies.router)
 
 
+@app.on_event("startup")
+async def apply_indexes():
+    await indexes.apply_indexes()
+    if config.index_check_on_startup:
+        await indexes.check_query_shapes()
+
+
+@app.on_event("startup")
+async def build_role_index():
+    if await config.db.role_index.estimated_document_count() == 0:
+        await companies_additional_funcs.rebuild_role_index()
+
+
+@app.on_event("startup")
+async def start_preview_cache_sweeper():
+    preview_cache.start_sweeper()
+
+
+@app.on_event("startup")
+async def start_job_worker():
+    jobs.start_worker()
+
+
+@app.on_event("startup")
+async def start_denylist_listener():
+    token_denylist.start()
+
+
+@app.on_event("shutdown")
+async def stop_preview_workers():
+    await token_denylist.stop()
+    await jobs.stop_worker()
+    await preview_cache.stop_sweeper()
+    previews_additional_funcs.shutdown()
+
+
+@app.on_event("shutdown")
+async def close_redis_pools():
+    for redis_client in (config.redis_deny_list, config.redis_refresh_tokens, config.redis_principal_cache):
+        await redis_client.connection_pool.disconnect()
+
+
 @app.get("/")
 async def main_page():
     return dict(message="Welcome to main page")
@@ -0,0 +1,98 @@
+"""
+Cost per document of turning mongo documents into json ready ones.
+Compares the recursive async walk the routers used before with additional_funcs/serialization.py.
+
+    python -m benchmarks.serialization
+"""
+import asyncio
+import copy
+import datetime
+import gc
+import time
+
+from bson import ObjectId, Decimal128
+
+from additional_funcs.serialization import delete_object_ids
+
+
+async def old_delete_object_ids_from_list(the_lists: list):
+    for elem_id in range(len(the_lists)):
+        if isinstance(the_lists[elem_id], ObjectId):
+            the_lists[elem_id] = str(the_lists[elem_id])
+        elif isinstance(the_lists[elem_id], dict):
+            the_lists[elem_id] = await old_delete_object_ids_from_dict(the_lists[elem_id])
+        elif isinstance(the_lists[elem_id], list):
+            the_lists[elem_id] = await old_delete_object_ids_from_list(the_lists[elem_id])
+    return the_lists
+
+
+async def old_delete_object_ids_from_dict(the_dict: dict):
+    for elem in the_dict.keys():
+        if isinstance(the_dict[elem], ObjectId):
+            the_dict[elem] = str(the_dict[elem])
+        elif isinstance(the_dict[elem], dict):
+            the_dict[elem] = await old_delete_object_ids_from_dict(the_dict[elem])
+        elif isinstance(the_dict[elem], list):
+            the_dict[elem] = await old_delete_object_ids_from_list(the_dict[elem])
+    return the_dict
+
+
+def make_company(divisions: int = 10, roles: int = 5, third_parties: int = 50, folders: int = 10):
+    permissions = dict(can_upload_files=True, can_download_files=True, can_add_filters=False,
+                       can_change_company_data=False, can_manage_employers=False)
+    return {
+        "_id": ObjectId(),
+        "name": "company",
+        "address": "address",
+        "recent_change": "16970000000000",
+        "doc_types": [{"doc_type_id": ObjectId(), "name": f"doc type {i}"} for i in range(10)],
+        "divisions": [{"division_id": ObjectId(), "name": f"division {i}",
+                       "available_roles": [{"role_id": ObjectId(), "name": f"role {j}",
+                                            "permissions": dict(permissions)} for j in range(roles)]}
+                      for i in range(divisions)],
+        "third_parties": [{"third_party_id": ObjectId(), "name": f"third party {i}",
+                           "folders": [{"third_party_folder_id": ObjectId(), "name": f"folder {j}"}
+                                       for j in range(folders)]}
+                          for i in range(third_parties)],
+        "available_signers": [{"available_signer_id": ObjectId(), "name": f"signer {i}"} for i in range(20)],
+        "subscription": {"valid_until": datetime.datetime.now(), "price": Decimal128("99.90")},
+    }
+
+
+def make_listing(files: int = 500):
+    return {"name": "third party",
+            "files_not_in_folders": {"without_doc_type": [{"_id": ObjectId(), "preview_path": "cache/a.jpeg",
+                                                           "name": "a.pdf"} for _ in range(files)],
+                                     "with_doc_type": {}},
+            "files_in_folders": {}}
+
+
+def time_per_document(func, document: dict, rounds: int):
+    # both versions convert in place, so every round gets its own copy. Like timeit, the best of a few
+    # repeats with the garbage collector off is kept
+    best = None
+    for _ in range(5):
+        copies = [copy.deepcopy(document) for _ in range(rounds)]
+        gc.disable()
+        start = time.perf_counter()
+        for elem in copies:
+            func(elem)
+        cost = (time.perf_counter() - start) / rounds
+        gc.enable()
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def measure(name: str, document: dict, rounds: int):
+    loop = asyncio.new_event_loop()
+    old_cost = time_per_document(lambda elem: loop.run_until_complete(old_delete_object_ids_from_dict(elem)),
+                                 document, rounds)
+    loop.close()
+    new_cost = time_per_document(delete_object_ids, document, rounds)
+    print(f'{name}: async walk {old_cost * 1e6:.0f} us, delete_object_ids {new_cost * 1e6:.0f} us '
+          f'per document ({old_cost / new_cost:.1f}x)')
+
+
+if __name__ == "__main__":
+    measure('company document', make_company(), 200)
+    measure('listing of 500 files', make_listing(), 200)
@@ -1,7 +1,8 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
 import redis
+import redis.asyncio as aredis
 from pydantic import BaseModel
 from datetime import timedelta
 
@@ -15,13 +16,123 @@ base_doc_types = ['Proposals', 'Contracts', 'Invoices']
 full_save_preview_file_path = r'C:\Users\aleks\PycharmProjects\pythonProject8\cache'
 
 content_to_response = ['_id', 'preview_path', 'name']
+# file listings are paged by _id, next_cursor of a page is passed as cursor to get the next one
+listing_page_size = int(os.getenv('LISTING_PAGE_SIZE', 500))
+listing_max_page_size = int(os.getenv('LISTING_MAX_PAGE_SIZE', 2000))
+# how many parent_id links the file history and the version tree follow from a file
+file_history_max_depth = int(os.getenv('FILE_HISTORY_MAX_DEPTH', 100))
 
+# uploads are streamed to a temporary file next to the final one, so the commit is an atomic rename
+upload_tmp_path = 'files/tmp'
+upload_chunk_size = 1024 * 1024
+# uploaded files are stored once per sha256, see blobs collection
+blobs_path = 'files/blobs'
+# companies can have their own limit in subscription.upload_size_limit
+max_upload_size = int(os.getenv('MAX_UPLOAD_SIZE', 100 * 1024 * 1024))
+# /files/upload-batch takes up to this many files, the size limit is applied to each of them
+upload_batch_max_files = int(os.getenv('UPLOAD_BATCH_MAX_FILES', 500))
+# files of a batch stored to disk at the same time
+upload_batch_concurrency = int(os.getenv('UPLOAD_BATCH_CONCURRENCY', 4))
+# /files/add_info_bulk changes at most this many files, given by id or matched by its filter
+bulk_update_max_files = int(os.getenv('BULK_UPDATE_MAX_FILES', 1000))
 
-redis_deny_list = redis.StrictRedis(host='localhost', port=6379, db=0)
-redis_refresh_tokens = redis.StrictRedis(host='localhost', port=6379, db=1)
+# previews are rendered by a process pool in the background, see additional_funcs/previews.py
+preview_workers = int(os.getenv('PREVIEW_WORKERS', 2))
+preview_queue_size = int(os.getenv('PREVIEW_QUEUE_SIZE', 100))
+preview_job_timeout = int(os.getenv('PREVIEW_JOB_TIMEOUT', 120))
+# seconds a background preview waits before it tries a full queue again
+preview_queue_retry_delay = int(os.getenv('PREVIEW_QUEUE_RETRY_DELAY', 5))
+# page/size/format variants of previews are rendered on demand and kept on disk
+preview_variants_path = full_save_preview_file_path + '/variants'
+preview_variant_formats = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+preview_variant_min_size = 16
+preview_variant_max_size = 1920
+preview_variant_quality = 80
+# the preview directory is a cache with a disk budget, evicted previews are rendered again on their next request
+preview_cache_max_bytes = int(os.getenv('PREVIEW_CACHE_MAX_BYTES', 5 * 1024 * 1024 * 1024))
+# 'lru' evicts the least recently used previews first, 'lfu' the least often used ones
+preview_cache_policy = os.getenv('PREVIEW_CACHE_POLICY', 'lru')
+# eviction goes down to this share of the budget, so it does not run on every new preview
+preview_cache_low_watermark = 0.9
+preview_cache_sweep_interval = int(os.getenv('PREVIEW_CACHE_SWEEP_INTERVAL', 60))
 
-client = MongoClient(port=27017)
-db = client.edmin
+# long work runs as jobs of the jobs collection, see additional_funcs/jobs.py. The worker of every process
+# looks for new jobs this often, a running job that does not report progress for job_lease_seconds is run again
+job_poll_interval = int(os.getenv('JOB_POLL_INTERVAL', 5))
+job_lease_seconds = int(os.getenv('JOB_LEASE_SECONDS', 60))
+# failed jobs are retried after job_retry_delay seconds, doubled on every attempt
+job_max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+job_retry_delay = int(os.getenv('JOB_RETRY_DELAY', 10))
+# files of a deleted company are removed this many at a time
+company_delete_batch_size = int(os.getenv('COMPANY_DELETE_BATCH_SIZE', 500))
+# files and users that point at a deleted third party, folder, signer, division or role are changed this many at a time
+cascade_batch_size = int(os.getenv('CASCADE_BATCH_SIZE', 1000))
+
+# downloads are sent in chunks with etag/last-modified validators and byte range support
+download_chunk_size = 64 * 1024
+download_max_ranges = 16
+# the content of an uploaded file never changes, but access to it can be taken away, so browsers revalidate it
+file_cache_control = 'private, no-cache'
+preview_cache_control = 'private, max-age=86400'
+# 'direct' sends downloads from the app, 'x-accel-redirect' (nginx) and 'x-sendfile' (apache, lighttpd)
+# only check the permissions and leave sending the file to the front proxy
+file_delivery_mode = os.getenv('FILE_DELIVERY_MODE', 'direct')
+if file_delivery_mode not in ('direct', 'x-accel-redirect', 'x-sendfile'):
+    raise ValueError(f'Unknown FILE_DELIVERY_MODE {file_delivery_mode}, check .env')
+# internal location of the proxy that is mapped to the working directory of the app, used by x-accel-redirect
+file_delivery_internal_prefix = os.getenv('FILE_DELIVERY_INTERNAL_PREFIX', '/protected/')
+
+
+redis_host = os.getenv('REDIS_HOST', 'localhost')
+redis_port = int(os.getenv('REDIS_PORT', 6379))
+# every redis db has one connection pool, shared by every request of the worker. When all connections are busy
+# a request waits up to redis_pool_timeout seconds for one
+redis_max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+redis_pool_timeout = int(os.getenv('REDIS_POOL_TIMEOUT', 5))
+
+redis_deny_list = aredis.StrictRedis(connection_pool=aredis.BlockingConnectionPool(
+    host=redis_host, port=redis_port, db=0, max_connections=redis_max_connections, timeout=redis_pool_timeout))
+redis_refresh_tokens = aredis.StrictRedis(connection_pool=aredis.BlockingConnectionPool(
+    host=redis_host, port=redis_port, db=1, max_connections=redis_max_connections, timeout=redis_pool_timeout))
+redis_principal_cache = aredis.StrictRedis(connection_pool=aredis.BlockingConnectionPool(
+    host=redis_host, port=redis_port, db=2, max_connections=redis_max_connections, timeout=redis_pool_timeout))
+# fastapi_jwt_auth calls the denylist loader synchronously, so the few tokens the in-process filter
+# can not rule out are looked up with a blocking client, see middlewares/token_denylist.py
+redis_deny_list_lookup = redis.StrictRedis(host=redis_host, port=redis_port, db=0)
+
+# resolved users are cached per jwt subject, see middlewares/principal_cache.py
+principal_cache_max_size = int(os.getenv('PRINCIPAL_CACHE_MAX_SIZE', 10000))
+principal_cache_ttl = int(os.getenv('PRINCIPAL_CACHE_TTL', 1800))
+principal_cache_recent_change_ttl = int(os.getenv('PRINCIPAL_CACHE_RECENT_CHANGE_TTL', 86400))
+
+# revoked tokens are checked against an in-process bloom filter first, see middlewares/token_denylist.py.
+# 2**21 bits and 7 hashes give about 1 false positive in 5000 checks with 100000 revoked tokens
+denylist_filter_bits = int(os.getenv('DENYLIST_FILTER_BITS', 2 ** 21))
+denylist_filter_hashes = int(os.getenv('DENYLIST_FILTER_HASHES', 7))
+denylist_confirmed_max_size = int(os.getenv('DENYLIST_CONFIRMED_MAX_SIZE', 10000))
+denylist_channel = os.getenv('DENYLIST_CHANNEL', 'token-denylist')
+# longest time a revocation whose pub/sub message was lost stays unknown to a worker
+denylist_sync_interval = int(os.getenv('DENYLIST_SYNC_INTERVAL', 30))
+
+mongo_host = os.getenv('MONGO_HOST', 'localhost')
+mongo_port = int(os.getenv('MONGO_PORT', 27017))
+mongo_db_name = os.getenv('MONGO_DB_NAME', 'edmin')
+# connection pool of the async driver, shared by every request of the worker
+mongo_max_pool_size = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+mongo_min_pool_size = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+mongo_max_idle_time_ms = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 60000))
+mongo_wait_queue_timeout_ms = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000))
+
+# indexes are created on startup, see additional_funcs/indexes.py. The check explains the queries of the routes
+# and stops the startup if one of them is not served by an index
+index_check_on_startup = os.getenv('INDEX_CHECK_ON_STARTUP', 'false').lower() == 'true'
+
+client = AsyncIOMotorClient(host=mongo_host, port=mongo_port,
+                            maxPoolSize=mongo_max_pool_size,
+                            minPoolSize=mongo_min_pool_size,
+                            maxIdleTimeMS=mongo_max_idle_time_ms,
+                            waitQueueTimeoutMS=mongo_wait_queue_timeout_ms)
+db = client[mongo_db_name]
 
 AUTHJWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=30)
 AUTHJWT_REFRESH_TOKEN_EXPIRES = timedelta(days=60)
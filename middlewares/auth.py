@@ -1,3 +1,4 @@
+import asyncio
 from typing import Optional
 
 from fastapi import FastAPI, HTTPException
@@ -6,8 +7,12 @@ from passlib.context import CryptContext
 import additional_funcs.users
 from models import users as users_modules
 from additional_funcs import users as users_additional_funcs
+from additional_funcs import serialization as serialization_additional_funcs
+from middlewares.principal_cache import principal_cache
+from middlewares.token_denylist import token_denylist
+from middlewares import company_loader
 from fastapi_jwt_auth import AuthJWT
-from datetime import datetime, timedelta
+from datetime import timedelta
 from bson import ObjectId
 import config
 
@@ -19,9 +24,7 @@ def get_config():
 
 @AuthJWT.token_in_denylist_loader
 def check_if_token_in_denylist(decrypted_token):
-    jti = decrypted_token['jti']
-    entry = config.redis_deny_list.get(jti)
-    return entry and entry == b'true'
+    return token_denylist.contains(decrypted_token['jti'], decrypted_token['exp'])
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -56,31 +59,39 @@ def get_password_hash(password):
 
 
 async def get_user(email_or_phone_or_id: str, _id_check: Optional[bool] = False, with_password: Optional[bool] = False):
+    subject = email_or_phone_or_id
+    if _id_check and not with_password:
+        principal = await principal_cache.get(subject)
+        if principal is not None:
+            return users_modules.User(**principal)
     user_from_session = True
     if _id_check:
         session_id = email_or_phone_or_id[24:]
         email_or_phone_or_id = email_or_phone_or_id[:24]
-        user_from_session = await additional_funcs.users.check_user_session_in_db(session_id)
-    user = await users_additional_funcs.check_user_email_password_in_db(email_or_phone_or_id, _id_check)
+        user_from_session, user = await asyncio.gather(
+            additional_funcs.users.check_user_session_in_db(session_id),
+            users_additional_funcs.check_user_email_password_in_db(email_or_phone_or_id, _id_check))
+    else:
+        user = await users_additional_funcs.check_user_email_password_in_db(email_or_phone_or_id, _id_check)
     if (user_from_session is True or user_from_session == user) and user is not None:
-        user = await users_additional_funcs.delete_object_ids_from_dict(user)
+        user = serialization_additional_funcs.delete_object_ids(user)
+        user_recent_change = user.get('recent_change')
         user['permissions'] = None
         user['is_division_admin'] = False
         user['is_role_admin'] = False
         user['id'] = user['_id']
+        role = None
         if user["role_id"] is not None:
             user["role_id"] = str(user["role_id"])
-            obj = list(config.db.companies.aggregate(
-                [{"$unwind": "$divisions"},
-                 {"$unwind": "$divisions.available_roles"},
-                 {"$match": {"divisions.available_roles.role_id": ObjectId(user['role_id'])}}]))
-            if len(obj) == 1:
-                user['permissions'] = obj[0]['divisions']['available_roles']['permissions']
-                if obj[0]['divisions']['name'] == 'admin':
+            role = await config.db.role_index.find_one({"_id": ObjectId(user['role_id'])})
+            if role is not None:
+                user['permissions'] = role['permissions']
+                if role['division_name'] == 'admin':
                     user['is_division_admin'] = True
-                if obj[0]['divisions']['available_roles']['name'] == 'admin':
+                if role['role_name'] == 'admin':
                     user['is_role_admin'] = True
-        elif user['division_id'] is not None:
+        # the role_id of a deleted role is cleared by a cascade job, until then its users get the division defaults
+        if role is None and user['division_id'] is not None:
             user['permissions'] = dict(can_upload_files=False,
                                        can_download_files=True,
                                        can_add_filters=False,
@@ -90,7 +101,18 @@ async def get_user(email_or_phone_or_id: str, _id_check: Optional[bool] = False,
         del user["_id"]
         if with_password:
             return users_modules.UserInDB(**user)
-        return users_modules.User(**user)
+        user = users_modules.User(**user)
+        if _id_check:
+            company_recent_change = None
+            if user.company_id is not None:
+                company = await company_loader.load_company(user.company_id)
+                company_recent_change = company.get('recent_change') if company is not None else None
+                if company is not None and company.get('deleting'):
+                    user.company_id, user.division_id, user.role_id, user.permissions = None, None, None, None
+                    user.is_division_admin, user.is_role_admin = False, False
+                    company_recent_change = None
+            await principal_cache.set(subject, user.dict(), user_recent_change, company_recent_change)
+        return user
     raise HTTPException(status_code=404, detail='Could not find the current_user')
 
 
@@ -104,7 +126,12 @@ async def authenticate_user(email_or_phone: str, password: str):
     return user
 
 
-async def revoke_token(jti: str, exp: int):
-    seconds = exp - int(str(datetime.timestamp(datetime.now())).split('.')[0])
-    config.redis_deny_list.setex(jti, seconds, 'true')
+async def revoke_tokens(tokens: list):
+    # (jti, exp) pairs, all of them are stored in one redis round trip
+    if len(tokens) != 0:
+        await token_denylist.revoke(tokens)
     return True
+
+
+async def revoke_token(jti: str, exp: int):
+    return await revoke_tokens([(jti, exp)])
@@ -0,0 +1,88 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Optional
+
+from bson import ObjectId
+
+import config
+
+
+# fields of the company the checks of a request read, the whole document is not needed by any of them
+company_loader_projection = {"recent_change": 1,
+                             "deleting": 1,
+                             "subscription.upload_size_limit": 1,
+                             "divisions.division_id": 1,
+                             "divisions.available_roles.role_id": 1,
+                             "available_signers.available_signer_id": 1,
+                             "third_parties.third_party_id": 1,
+                             "third_parties.folders.third_party_folder_id": 1,
+                             "doc_types.doc_type_id": 1}
+
+# company_id -> future of the projected company, one dict per request
+request_companies: ContextVar[Optional[dict]] = ContextVar('request_companies', default=None)
+
+
+class CompanyLoaderMiddleware(object):
+    """
+    Gives every http request its own memo of loaded companies
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        token = request_companies.set(dict())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_companies.reset(token)
+
+
+async def load_company(company_id: str):
+    """
+    The company projected to company_loader_projection. Within a request it is read once,
+    concurrent and later callers get the same document
+    """
+    companies = request_companies.get()
+    if companies is None:
+        return await config.db.companies.find_one({"_id": ObjectId(company_id)}, company_loader_projection)
+    job = companies.get(str(company_id))
+    if job is None:
+        job = asyncio.ensure_future(
+            config.db.companies.find_one({"_id": ObjectId(company_id)}, company_loader_projection))
+        companies[str(company_id)] = job
+    return await asyncio.shield(job)
+
+
+def get_company_ids(company: dict, id_name: str):
+    if id_name == 'division_id':
+        return {elem.get('division_id') for elem in company.get('divisions', list())}
+    if id_name == 'role_id':
+        return {role.get('role_id') for elem in company.get('divisions', list())
+                for role in elem.get('available_roles', list())}
+    if id_name == 'available_signer_id':
+        return {elem.get('available_signer_id') for elem in company.get('available_signers', list())}
+    if id_name == 'third_party_id':
+        return {elem.get('third_party_id') for elem in company.get('third_parties', list())}
+    if id_name == 'third_party_folder_id':
+        return {folder.get('third_party_folder_id') for elem in company.get('third_parties', list())
+                for folder in elem.get('folders', list())}
+    if id_name == 'doc_type_id':
+        return {elem.get('doc_type_id') for elem in company.get('doc_types', list())}
+    return set()
+
+
+def get_third_party_folder_ids(company: dict, third_party_id: ObjectId):
+    for elem in company.get('third_parties', list()):
+        if elem.get('third_party_id') == third_party_id:
+            return {folder.get('third_party_folder_id') for folder in elem.get('folders', list())}
+    return set()
+
+
+def get_folder_third_party_id(company: dict, third_party_folder_id: ObjectId):
+    for elem in company.get('third_parties', list()):
+        for folder in elem.get('folders', list()):
+            if folder.get('third_party_folder_id') == third_party_folder_id:
+                return elem.get('third_party_id')
+    return None
@@ -0,0 +1,112 @@
+import json
+from collections import OrderedDict
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+import config
+
+
+def _principal_key(subject: str):
+    return f'principal:{subject}'
+
+
+def _recent_change_key(kind: str, _id: Optional[str]):
+    return f'recent_change:{kind}:{_id}'
+
+
+def _recent_change_keys(principal: dict):
+    # a user without a company depends on the recent_change of the user only
+    keys = [_recent_change_key('user', principal['id'])]
+    if principal['company_id'] is not None:
+        keys.append(_recent_change_key('company', principal['company_id']))
+    return keys
+
+
+class PrincipalCache(object):
+    """
+    Resolved users with their permissions keyed by jwt subject (user id + session id).
+    Entries live in a bounded in-process LRU backed by redis, both copies are only trusted while the
+    recent_change of the user and of its company are still the ones the entry was built from.
+    The current recent_change values are kept in redis, so a change made by any worker invalidates the others.
+    """
+    def __init__(self, max_size: int, ttl: int, recent_change_ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.recent_change_ttl = recent_change_ttl
+        self._entries = OrderedDict()
+
+    def _remember(self, subject: str, entry: dict):
+        self._entries[subject] = entry
+        self._entries.move_to_end(subject)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _is_fresh(entry: dict, recent_changes: list):
+        recent_changes = [None if elem is None else elem.decode() for elem in recent_changes]
+        if len(recent_changes) == 1:
+            recent_changes.append(None)
+        return recent_changes == [entry['user_recent_change'], entry['company_recent_change']]
+
+    async def get(self, subject: str):
+        entry = self._entries.get(subject)
+        try:
+            if entry is None:
+                raw_entry = await config.redis_principal_cache.get(_principal_key(subject))
+                if raw_entry is None:
+                    return None
+                entry = json.loads(raw_entry)
+            recent_changes = await config.redis_principal_cache.mget(*_recent_change_keys(entry['principal']))
+        except RedisError as e:
+            print(e)
+            return None
+        if not self._is_fresh(entry, recent_changes):
+            self._entries.pop(subject, None)
+            return None
+        self._remember(subject, entry)
+        return entry['principal']
+
+    async def set(self, subject: str, principal: dict,
+                  user_recent_change: Optional[str], company_recent_change: Optional[str]):
+        if user_recent_change is None or (principal['company_id'] is not None and company_recent_change is None):
+            return None
+        if principal['company_id'] is None:
+            company_recent_change = None
+        entry = dict(principal=principal,
+                     user_recent_change=user_recent_change,
+                     company_recent_change=company_recent_change)
+        keys = _recent_change_keys(principal)
+        try:
+            pipe = config.redis_principal_cache.pipeline(transaction=False)
+            # a newer recent_change written in the meantime must not be overwritten by the one just read from db
+            pipe.set(keys[0], user_recent_change, ex=self.recent_change_ttl, nx=True)
+            if len(keys) > 1:
+                pipe.set(keys[1], company_recent_change, ex=self.recent_change_ttl, nx=True)
+            pipe.mget(*keys)
+            recent_changes = (await pipe.execute())[-1]
+            if not self._is_fresh(entry, recent_changes):
+                return None
+            await config.redis_principal_cache.setex(_principal_key(subject), self.ttl, json.dumps(entry))
+        except RedisError as e:
+            print(e)
+            return None
+        self._remember(subject, entry)
+
+    async def _changed(self, kind: str, _id: str, recent_change: str):
+        try:
+            await config.redis_principal_cache.setex(_recent_change_key(kind, _id), self.recent_change_ttl,
+                                                     recent_change)
+        except RedisError as e:
+            print(e)
+
+    async def user_changed(self, user_id: str, recent_change: str):
+        await self._changed('user', str(user_id), recent_change)
+
+    async def company_changed(self, company_id: str, recent_change: str):
+        await self._changed('company', str(company_id), recent_change)
+
+
+principal_cache = PrincipalCache(max_size=config.principal_cache_max_size,
+                                 ttl=config.principal_cache_ttl,
+                                 recent_change_ttl=config.principal_cache_recent_change_ttl)
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+
+import config
+
+
+class TokenDenylist(object):
+    """
+    jtis of revoked tokens. A bloom filter of all of them and an LRU of confirmed ones sit in front of redis,
+    so only tokens the filter can not rule out are looked up there, which almost never happens.
+    Revocations reach the filters of all workers through redis pub/sub. The filter is built again from redis
+    on every (re)subscribe and every sync_interval seconds, that bounds the effect of a lost message and drops
+    expired tokens. While a worker is not subscribed it asks redis for every token
+    """
+    def __init__(self, bits: int, hashes: int, max_size: int, sync_interval: int):
+        self.bits = bits
+        self.hashes = hashes
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+        self.ready = False
+        self._filter = bytearray(bits // 8 + 1)
+        self._confirmed = OrderedDict()
+        self._listener_task = None
+
+    def _positions(self, jti: str):
+        digest = hashlib.blake2b(jti.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def _add(self, bloom_filter: bytearray, jti: str):
+        for position in self._positions(jti):
+            bloom_filter[position >> 3] |= 1 << (position & 7)
+
+    def _might_contain(self, jti: str):
+        bloom_filter = self._filter
+        return all(bloom_filter[position >> 3] & (1 << (position & 7)) for position in self._positions(jti))
+
+    def _remember(self, jti: str, exp: int):
+        self._confirmed[jti] = exp
+        self._confirmed.move_to_end(jti)
+        while len(self._confirmed) > self.max_size:
+            self._confirmed.popitem(last=False)
+
+    def add(self, jti: str, exp: int):
+        self._add(self._filter, jti)
+        self._remember(jti, exp)
+
+    def contains(self, jti: str, exp: int):
+        if self.ready and not self._might_contain(jti):
+            return False
+        confirmed_exp = self._confirmed.get(jti)
+        if confirmed_exp is not None and confirmed_exp > time.time():
+            self._confirmed.move_to_end(jti)
+            return True
+        entry = config.redis_deny_list_lookup.get(jti)
+        if entry and entry == b'true':
+            self._remember(jti, exp)
+            return True
+        return False
+
+    async def revoke(self, tokens: list):
+        """
+        Stores (jti, exp) pairs in redis and tells the other workers about them, in one round trip
+        """
+        now = int(time.time())
+        pipe = config.redis_deny_list.pipeline(transaction=False)
+        for jti, exp in tokens:
+            self.add(jti, exp)
+            pipe.setex(jti, max(exp - now, 1), 'true')
+            pipe.publish(config.denylist_channel, jti)
+        await pipe.execute()
+
+    async def _rebuild(self):
+        bloom_filter = bytearray(self.bits // 8 + 1)
+        async for key in config.redis_deny_list.scan_iter(count=1000):
+            self._add(bloom_filter, key.decode())
+        self._filter = bloom_filter
+        self.ready = True
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pubsub = config.redis_deny_list.pubsub()
+            try:
+                await pubsub.subscribe(config.denylist_channel)
+                # messages published during a rebuild wait on the connection and are applied after it
+                await self._rebuild()
+                next_sync = loop.time() + self.sync_interval
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None:
+                        self._add(self._filter, message['data'].decode())
+                    if loop.time() >= next_sync:
+                        await self._rebuild()
+                        next_sync = loop.time() + self.sync_interval
+            except Exception as e:
+                print(e)
+                self.ready = False
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    def start(self):
+        if self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            self._listener_task = None
+        self.ready = False
+
+
+token_denylist = TokenDenylist(bits=config.denylist_filter_bits,
+                               hashes=config.denylist_filter_hashes,
+                               max_size=config.denylist_confirmed_max_size,
+                               sync_interval=config.denylist_sync_interval)
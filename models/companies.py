@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Optional, List, ClassVar
 from pydantic import BaseModel, validator, root_validator, Field
 from fastapi import Form
 from bson import ObjectId
@@ -32,10 +32,12 @@ class AvailableRolesCreateWithId(BaseModel):
     name: str
     permissions: Optional[CreatePermissions] = CreatePermissions()
 
+    # checked against the company of the user in the route, see additional_funcs/references.py
+    company_references: ClassVar[tuple] = ('division_id',)
+
     @validator('division_id', allow_reuse=True)
     def check_divisions_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"divisions.division_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('division._id validation failed')
         return value
 
@@ -46,12 +48,10 @@ class AvailableRolesEdit(BaseModel):
     permissions: Optional[EditPermissions]
     delete_me: Optional[bool] = False
 
+    # the route reads the role from role_index of the company of the user
     @validator('role_id', allow_reuse=True)
     def check_available_roles_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) or not len(list(config.db.companies.aggregate(
-                [{"$unwind": "$divisions"},
-                 {"$unwind": "$divisions.available_roles"},
-                 {"$match": {"divisions.available_roles.role_id": ObjectId(value)}}]))) == 1:
+        if not ObjectId.is_valid(value):
             raise ValueError('divisions.available_signers.role_id validation failed')
         return value
 
@@ -84,10 +84,11 @@ class DivisionEdit(BaseModel):
     name: Optional[str] = Field(nullable=False)
     delete_me: Optional[bool] = False
 
+    company_references: ClassVar[tuple] = ('division_id',)
+
     @validator('division_id', allow_reuse=True)
     def check_divisions_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"divisions.division_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('division._id validation failed')
         return value
 
@@ -113,10 +114,11 @@ class ThirdPartyEdit(BaseModel):
     name: Optional[str] = Field(nullable=False)
     delete_me: Optional[bool] = False
 
+    company_references: ClassVar[tuple] = ('third_party_id',)
+
     @validator('third_party_id', allow_reuse=True)
     def check_third_parties_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"third_parties.third_party_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('third_parties._id validation failed')
         return value
 
@@ -138,10 +140,11 @@ class ThirdPartyFolderCreate(BaseModel):
     third_party_id: str = Form(..., min_length=24, max_length=24)
     name: str
 
+    company_references: ClassVar[tuple] = ('third_party_id',)
+
     @validator('third_party_id', allow_reuse=True)
     def check_third_parties_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"third_parties.third_party_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('third_parties._id validation failed')
         return value
 
@@ -151,12 +154,11 @@ class ThirdPartyFolderEdit(BaseModel):
     name: Optional[str] = Field(nullable=False)
     delete_me: Optional[bool] = False
 
+    company_references: ClassVar[tuple] = ('third_party_folder_id',)
+
     @validator('third_party_folder_id', allow_reuse=True)
     def check_third_parties_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) or not len(list(config.db.companies.aggregate(
-                [{"$unwind": "$third_parties"},
-                 {"$unwind": "$third_parties.folders"},
-                 {"$match": {"third_parties.folders.third_party_folder_id": ObjectId(value)}}]))) == 1:
+        if not ObjectId.is_valid(value):
             raise ValueError('third_parties._id validation failed')
         return value
 
@@ -188,10 +190,11 @@ class DocTypeEdit(BaseModel):
     doc_type_id: str = Form(..., min_length=24, max_length=24)
     name: Optional[str] = Field(nullable=False)
 
+    company_references: ClassVar[tuple] = ('doc_type_id',)
+
     @validator('doc_type_id', allow_reuse=True)
     def check_third_parties_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"doc_types.doc_type_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('third_parties._id validation failed')
         return value
 
@@ -220,6 +223,8 @@ class AvailableSignerEdit(BaseModel):
     delete_patronymic: Optional[bool] = False
     delete_me: Optional[bool] = False
 
+    company_references: ClassVar[tuple] = ('available_signer_id',)
+
     @validator('available_signer_id', allow_reuse=True)
     def check_available_signers_id_omitted(cls, value):
         if not ObjectId.is_valid(value):
@@ -248,6 +253,7 @@ class Subscription(BaseModel):
     price_value: Optional[int] = None
     start_date: Optional[str] = None
     expiration_date: Optional[str] = None
+    upload_size_limit: Optional[int] = None
 
     @validator('start_date', allow_reuse=True)
     def check_start_date_omitted(cls, value):
@@ -1,7 +1,6 @@
-from typing import Optional
+from typing import Optional, List, ClassVar
 from fastapi import Form
-from pydantic import BaseModel, root_validator, validator
-import config
+from pydantic import BaseModel, Extra, Field, root_validator, validator
 from bson import ObjectId
 
 
@@ -18,9 +17,15 @@ class ItemUploadFileEmpty(object):
         self.doc_type_id = None
 
 
-class ItemAddFileInfo(BaseModel):
-    file_id: str = Form(..., min_length=24, max_length=24)
-    parent_id: Optional[str] = Form(None, min_length=24, max_length=24)
+def check_deletes_omitted(values: dict, names: tuple):
+    for name in names:
+        if (name in values and 'delete_' + name in values) \
+                or ('delete_' + name in values and not values['delete_' + name]):
+            raise ValueError(f"Parse 'delete_{name}' True and do not parse {name} to delete'")
+    return values
+
+
+class ItemFileInfoPatch(BaseModel):
     status: Optional[str]
     division_id: Optional[str] = Form(None, min_length=24, max_length=24)
     third_party_id: Optional[str] = Form(None, min_length=24, max_length=24)
@@ -33,75 +38,93 @@ class ItemAddFileInfo(BaseModel):
     delete_third_party_id: Optional[bool] = False
     delete_third_party_folder_id: Optional[bool] = False
     delete_division_id: Optional[bool] = False
-    delete_parent_id: Optional[bool] = False
     delete_available_signer_id: Optional[bool] = False
 
-    @root_validator(pre=True)
-    def check_optional_amount_omitted(cls, values):
-        if not len(values) - int('file_id' in values) > 0:
-            raise ValueError('one of the optional should be included')
+    # checked against the company of the user in the route, see additional_funcs/references.py
+    company_references: ClassVar[tuple] = ('division_id', 'third_party_id', 'available_signer_id',
+                                           'third_party_folder_id', 'doc_type_id')
 
-        if ('parent_id' in values and 'delete_parent_id' in values) \
-                or ('delete_parent_id' in values and not values['delete_parent_id']):
-            raise ValueError(f"Parse 'delete_parent_id' True and do not parse parent_id to delete'")
+    class Config:
+        # an unknown field would pass as the one optional field and update nothing
+        extra = Extra.forbid
 
-        if ('available_signer_id' in values and 'delete_available_signer_id' in values) \
-                or ('delete_available_signer_id' in values and not values['delete_available_signer_id']):
-            raise ValueError(f"Parse 'delete_available_signer_id' True and do not parse available_signer_id to delete'")
+    @root_validator(pre=True)
+    def check_deletes_omitted(cls, values):
+        return check_deletes_omitted(values, ('available_signer_id', 'division_id', 'third_party_id',
+                                              'third_party_folder_id', 'doc_type_id'))
+
+    @validator('division_id', 'third_party_id', 'available_signer_id', 'third_party_folder_id', 'doc_type_id',
+               allow_reuse=True)
+    def check_ids_format(cls, value, field):
+        if not ObjectId.is_valid(value):
+            raise ValueError(f'{field.name} validation failed')
+        return value
 
-        if ('division_id' in values and 'delete_division_id' in values) \
-                or ('delete_division_id' in values and not values['delete_division_id']):
-            raise ValueError(f"Parse 'delete_division_id' True and do not parse division_id to delete'")
 
-        if ('third_party_id' in values and 'delete_third_party_id' in values) \
-                or ('delete_third_party_id' in values and not values['delete_third_party_id']):
-            raise ValueError(f"Parse 'delete_third_party_id' True and do not parse third_party_id to delete'")
+class ItemAddFileInfo(ItemFileInfoPatch):
+    file_id: str = Form(..., min_length=24, max_length=24)
+    parent_id: Optional[str] = Form(None, min_length=24, max_length=24)
+    delete_parent_id: Optional[bool] = False
 
-        if ('third_party_folder_id' in values and 'delete_third_party_folder_id' in values) \
-                or ('delete_third_party_folder_id' in values and not values['delete_third_party_folder_id']):
-            raise ValueError(f"Parse 'delete_third_party_folder_id' True and do not parse "
-                             f"third_party_folder_id to delete'")
+    class Config:
+        extra = Extra.ignore
 
-        if ('doc_type_id' in values and 'delete_doc_type_id' in values) \
-                or ('delete_doc_type_id' in values and not values['delete_doc_type_id']):
-            raise ValueError(f"Parse 'delete_doc_type_id' True and do not parse "
-                             f"doc_type_id to delete'")
+    @root_validator(pre=True)
+    def check_parent_delete_omitted(cls, values):
+        return check_deletes_omitted(values, ('parent_id',))
 
+    @root_validator(pre=True)
+    def check_optional_amount_omitted(cls, values):
+        if not len(values) - int('file_id' in values) > 0:
+            raise ValueError('one of the optional should be included')
         return values
 
-    @validator('division_id', allow_reuse=True)
-    def check_divisions_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"divisions.division_id": ObjectId(value)}) is None:
-            raise ValueError('division._id validation failed')
+    @validator('file_id', 'parent_id', allow_reuse=True)
+    def check_file_ids_format(cls, value, field):
+        if not ObjectId.is_valid(value):
+            raise ValueError(f'{field.name} validation failed')
         return value
 
-    @validator('third_party_id', allow_reuse=True)
-    def check_third_parties_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"third_parties.third_party_id": ObjectId(value)}) is None:
-            raise ValueError('third_parties._id validation failed')
-        return value
 
-    @validator('available_signer_id', allow_reuse=True)
-    def check_available_signers_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"available_signers._id": ObjectId(value)}) is None:
-            raise ValueError('available_signers._id validation failed')
-        return value
+class FilesFilter(BaseModel):
+    division_id: Optional[str] = None
+    third_party_id: Optional[str] = None
+    available_signer_id: Optional[str] = None
+    third_party_folder_id: Optional[str] = None
+    doc_type_id: Optional[str] = None
+
+    @root_validator(pre=True)
+    def check_optional_amount_omitted(cls, values):
+        if len(values) == 0:
+            raise ValueError('one of the optional should be included')
+        for v in values.keys():
+            if values[v] is None:
+                raise ValueError(f"Field '{v}' must not be None")
+        return values
 
-    @validator('third_party_folder_id', allow_reuse=True)
-    def check_third_parties_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) or not len(list(config.db.companies.aggregate(
-                [{"$unwind": "$third_parties"},
-                 {"$unwind": "$third_parties.folders"},
-                 {"$match": {"third_parties.folders.third_party_folder_id": ObjectId(value)}}]))) == 1:
-            raise ValueError('third_parties._id validation failed')
+    @validator('division_id', 'third_party_id', 'available_signer_id', 'third_party_folder_id', 'doc_type_id',
+               allow_reuse=True)
+    def check_ids_format(cls, value, field):
+        if not ObjectId.is_valid(value):
+            raise ValueError(f'{field.name} validation failed')
         return value
 
-    @validator('doc_type_id', allow_reuse=True)
-    def check_third_parties_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) \
-                or config.db.companies.find_one({"doc_types.doc_type_id": ObjectId(value)}) is None:
-            raise ValueError('third_parties._id validation failed')
-        return value
\ No newline at end of file
+
+class ItemAddFilesInfo(BaseModel):
+    file_ids: Optional[List[str]] = Field(None, min_items=1)
+    filter: Optional[FilesFilter] = None
+    info: ItemFileInfoPatch
+
+    @root_validator(pre=True)
+    def check_files_omitted(cls, values):
+        if int(values.get('file_ids') is not None) + int(values.get('filter') is not None) != 1:
+            raise ValueError("Parse either 'file_ids' or 'filter'")
+        if isinstance(values.get('info'), dict) and len(values['info']) == 0:
+            raise ValueError('one of the optional should be included')
+        return values
+
+    @validator('file_ids', each_item=True, allow_reuse=True)
+    def check_file_ids_format(cls, value):
+        if not ObjectId.is_valid(value):
+            raise ValueError('file_ids validation failed')
+        return value
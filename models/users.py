@@ -1,8 +1,7 @@
-from typing import Optional
+from typing import Optional, ClassVar
 from pydantic import BaseModel, validator
 from validate_email import validate_email
 from bson import ObjectId
-import config
 
 
 class Permissions(BaseModel):
@@ -24,6 +23,9 @@ class ItemUserSignUp(BaseModel):
     company_id: Optional[str] = None
     role_id: Optional[str] = None
 
+    # checked against the company of company_id in the route, see additional_funcs/references.py
+    company_references: ClassVar[tuple] = ('division_id', 'role_id')
+
     @validator('email', allow_reuse=True)
     def check_email_omitted(cls, value):
         if not validate_email(value):
@@ -32,19 +34,19 @@ class ItemUserSignUp(BaseModel):
 
     @validator('company_id', allow_reuse=True)
     def check_company_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) or config.db.companies.find_one({"_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('company_id validation failed')
         return value
 
     @validator('division_id', allow_reuse=True)
     def check_division_omitted(cls, value):
-        if not ObjectId.is_valid(value) or config.db.users.find_one({"division_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('division_id validation failed')
         return value
 
     @validator('role_id', allow_reuse=True)
     def check_role_id_omitted(cls, value):
-        if not ObjectId.is_valid(value) or config.db.users.find_one({"role_id": ObjectId(value)}) is None:
+        if not ObjectId.is_valid(value):
             raise ValueError('role_id validation failed')
         return value
 
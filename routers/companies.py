@@ -1,10 +1,16 @@
+import asyncio
 import datetime
 
 from fastapi import APIRouter, Depends, HTTPException
 
 import config
 from middlewares import auth as auth_middlewares
+from middlewares import company_loader
+from middlewares.principal_cache import principal_cache
 from additional_funcs import companies as companies_additional_funcs
+from additional_funcs import jobs as jobs_additional_funcs
+from additional_funcs import references as references_additional_funcs
+from additional_funcs import responses as responses_additional_funcs
 from models import companies as companies_modules
 from pymongo import ReturnDocument
 from bson import ObjectId
@@ -13,7 +19,8 @@ from bson import ObjectId
 router = APIRouter(
     prefix="/companies",
     tags=["companies"],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    route_class=responses_additional_funcs.NegotiatedRoute
 )
 
 
@@ -46,15 +53,17 @@ async def create_company(company: companies_modules.ItemCompanyCreate,
     company_dict['subscription'] = companies_modules.Subscription().dict()
     company_dict["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
     company_dict = await companies_additional_funcs.fill_in_object_ids_dict(company_dict)
-    config.db.companies.insert_one(company_dict)
+    await config.db.companies.insert_one(company_dict)
+    await companies_additional_funcs.index_company_roles(company_dict)
 
-    config.db.users.update_one({'_id': ObjectId(current_user.id)},
-                               {'$set': {'company_id': company_dict["_id"],
-                                         'division_id': company_dict["divisions"][0]["division_id"],
-                                         'role_id': company_dict["divisions"][0]["available_roles"][0]["role_id"],
-                                         "recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}})
-    company_dict = await companies_additional_funcs.delete_object_ids_from_dict(company_dict)
-    return company_dict
+    recent_change = str(datetime.datetime.now().timestamp()).replace('.', '')
+    await config.db.users.update_one({'_id': ObjectId(current_user.id)},
+                                     {'$set': {'company_id': company_dict["_id"],
+                                               'division_id': company_dict["divisions"][0]["division_id"],
+                                               'role_id': company_dict["divisions"][0]["available_roles"][0]["role_id"],
+                                               "recent_change": recent_change}})
+    await principal_cache.user_changed(current_user.id, recent_change)
+    return responses_additional_funcs.MongoResponse(company_dict)
 
 
 @router.post("/create-third-party")
@@ -66,7 +75,7 @@ async def create_third_party(third_party: companies_modules.ThirdPartyCreate,
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id)},
         {
             '$push': {
@@ -79,7 +88,8 @@ async def create_third_party(third_party: companies_modules.ThirdPartyCreate,
             '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -92,31 +102,37 @@ async def edit_third_party(third_party: companies_modules.ThirdPartyEdit,
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
+    await references_additional_funcs.check_references(third_party, current_user.company_id)
     item_updated = dict()
     for elem in third_party:
         if elem[0] == 'delete_me' and elem[1]:
-            obj = config.db.companies.find_one_and_update(
+            obj = await config.db.companies.find_one_and_update(
                 {"_id": ObjectId(current_user.company_id)},
                 {
-                    '$pull': {"third_parties": {"third_party_id": ObjectId(third_party.third_party_id)}}
+                    '$pull': {"third_parties": {"third_party_id": ObjectId(third_party.third_party_id)}},
+                    '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
                 }, return_document=ReturnDocument.AFTER)
             if obj is not None:
-                config.db.files.update({"third_party_id": ObjectId(third_party.third_party_id)},
-                                       {"$set": {"third_party_id": None}})
-                return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+                await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+                job = await companies_additional_funcs.enqueue_cascade(current_user.company_id, current_user.id,
+                                                                       'third_party',
+                                                                       third_party.third_party_id)
+                obj['cascade_job'] = jobs_additional_funcs.get_job_view(job)
+                return responses_additional_funcs.MongoResponse(obj)
             raise HTTPException(status_code=404, detail='Could not find an object')
         if elem[0] != 'third_party_id' and elem[0] != 'delete_me':
             item_updated['third_parties.$.' + str(elem[0])] = elem[1]
     item_updated = await companies_additional_funcs.fill_in_object_ids_dict(item_updated)
     item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id),
          "third_parties.third_party_id": ObjectId(third_party.third_party_id)},
         {
             '$set': item_updated
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -129,7 +145,7 @@ async def create_available_signer(available_signer: companies_modules.AvailableS
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id)},
         {
             '$push': {
@@ -143,7 +159,8 @@ async def create_available_signer(available_signer: companies_modules.AvailableS
             '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -156,31 +173,37 @@ async def edit_available_signer(available_signer: companies_modules.AvailableSig
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
+    await references_additional_funcs.check_references(available_signer, current_user.company_id)
     item_updated = dict()
     for elem in available_signer:
         if elem[0] == 'delete_me' and elem[1]:
-            obj = config.db.companies.find_one_and_update(
+            obj = await config.db.companies.find_one_and_update(
                 {"_id": ObjectId(current_user.company_id)},
                 {
                     '$pull': {"available_signers":
-                              {"available_signer_id": ObjectId(available_signer.available_signer_id)}}
+                              {"available_signer_id": ObjectId(available_signer.available_signer_id)}},
+                    '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
                 }, return_document=ReturnDocument.AFTER)
             if obj is not None:
-                config.db.files.update({"available_signer_id": ObjectId(available_signer.available_signer_id)},
-                                       {"$set": {"available_signer_id": None}})
-                return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+                await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+                job = await companies_additional_funcs.enqueue_cascade(current_user.company_id, current_user.id,
+                                                                       'available_signer',
+                                                                       available_signer.available_signer_id)
+                obj['cascade_job'] = jobs_additional_funcs.get_job_view(job)
+                return responses_additional_funcs.MongoResponse(obj)
             raise HTTPException(status_code=404, detail='Could not find an object')
         if elem[0] != 'available_signer_id' and elem[0] != 'delete_me':
             item_updated['available_signers.$.' + str(elem[0])] = elem[1]
     item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id),
          "available_signers.available_signer_id": ObjectId(available_signer.available_signer_id)},
         {
             '$set': await companies_additional_funcs.fill_in_object_ids_dict(item_updated)
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -210,7 +233,7 @@ async def create_division(division: companies_modules.DivisionCreate,
                    "name": division.name,
                    "available_roles": available_roles
                    }
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id)},
         {
             '$push': {
@@ -219,7 +242,9 @@ async def create_division(division: companies_modules.DivisionCreate,
             '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await companies_additional_funcs.index_company_roles(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -232,27 +257,33 @@ async def edit_division(division: companies_modules.DivisionEdit,
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
+    await references_additional_funcs.check_references(division, current_user.company_id)
     if division.name == "admin":
         raise HTTPException(status_code=400, detail='Division name cannot be "admin"')
     item_updated = dict()
     for elem in division:
         if elem[0] == 'delete_me' and elem[1]:
-            obj = config.db.companies.find_one_and_update(
+            obj = await config.db.companies.find_one_and_update(
                 {"_id": ObjectId(current_user.company_id),
                  "divisions": {"$elemMatch": {"division_id": ObjectId(division.division_id),
                                               "name": {"$ne": "admin"}}}},
                 {
-                    '$pull': {"divisions": {"division_id": ObjectId(division.division_id)}}
+                    '$pull': {"divisions": {"division_id": ObjectId(division.division_id)}},
+                    '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
                 }, return_document=ReturnDocument.AFTER)
             if obj is not None:
-                config.db.files.update({"division_id": ObjectId(division.division_id)},
-                                       {"$set": {"division_id": None}})
-                return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+                await companies_additional_funcs.index_company_roles(obj)
+                await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+                job = await companies_additional_funcs.enqueue_cascade(current_user.company_id, current_user.id,
+                                                                       'division',
+                                                                       division.division_id)
+                obj['cascade_job'] = jobs_additional_funcs.get_job_view(job)
+                return responses_additional_funcs.MongoResponse(obj)
             raise HTTPException(status_code=404, detail='Could not find an object')
         elif elem[0] != 'division_id' and elem[1] is not None and elem[0] != 'delete_me':
             item_updated['divisions.$.' + str(elem[0])] = elem[1]
     item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id),
          "divisions": {"$elemMatch": {"division_id": ObjectId(division.division_id),
                                       "name": {"$ne": "admin"}}}},
@@ -260,7 +291,9 @@ async def edit_division(division: companies_modules.DivisionEdit,
             '$set': await companies_additional_funcs.fill_in_object_ids_dict(item_updated)
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await companies_additional_funcs.index_company_roles(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -273,11 +306,12 @@ async def create_available_role(available_role: companies_modules.AvailableRoles
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
+    await references_additional_funcs.check_references(available_role, current_user.company_id)
     check_dict = {"_id": ObjectId(current_user.company_id),
                   "divisions.division_id": ObjectId(available_role.division_id)}
     if available_role.name == 'admin':
         check_dict['name'] = {"divisions.$.name": {"$ne": "admin"}}
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         check_dict,
         {
             '$push': {
@@ -290,7 +324,9 @@ async def create_available_role(available_role: companies_modules.AvailableRoles
             '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await companies_additional_funcs.index_company_roles(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -303,39 +339,45 @@ async def create_available_role(available_role: companies_modules.AvailableRoles
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    available_role_obj = list(config.db.companies.aggregate(
-                [{"$unwind": "$divisions"},
-                 {"$unwind": "$divisions.available_roles"},
-                 {"$match": {"divisions.available_roles.role_id": ObjectId(available_role.role_id)}}]))[0]
-    if available_role_obj['divisions']['name'] == "admin" \
-            and available_role_obj['divisions']['available_roles']['name'] == "admin":
+    available_role_obj = await config.db.role_index.find_one({"_id": ObjectId(available_role.role_id),
+                                                              "company_id": ObjectId(current_user.company_id)})
+    if available_role_obj is None:
+        raise HTTPException(status_code=404, detail='Could not find an object')
+    if available_role_obj['division_name'] == "admin" and available_role_obj['role_name'] == "admin":
         raise HTTPException(status_code=400, detail='Division and role name cannot be "admin"')
     item_updated = dict()
-    array_filters = [{'outer.division_id': available_role_obj['divisions']['division_id']},
+    array_filters = [{'outer.division_id': available_role_obj['division_id']},
                      {"inner.role_id": ObjectId(available_role.role_id)}]
     for elem in available_role:
         if elem[0] == 'delete_me' and elem[1]:
-            obj = config.db.companies.find_one_and_update(
+            obj = await config.db.companies.find_one_and_update(
                 {"_id": ObjectId(current_user.company_id),
-                 "divisions.division_id": available_role_obj['divisions']['division_id']},
+                 "divisions.division_id": available_role_obj['division_id']},
                 {
-                    '$pull': {"divisions.$[].available_roles": {"role_id": ObjectId(available_role.role_id)}}
+                    '$pull': {"divisions.$[].available_roles": {"role_id": ObjectId(available_role.role_id)}},
+                    '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
                 }, return_document=ReturnDocument.AFTER)
             if obj is not None:
-                config.db.users.update({"role_id": ObjectId(available_role.role_id)},
-                                       {"$set": {"role_id": None}})
-                return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+                await companies_additional_funcs.index_company_roles(obj)
+                await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+                job = await companies_additional_funcs.enqueue_cascade(current_user.company_id, current_user.id,
+                                                                       'role',
+                                                                       available_role.role_id)
+                obj['cascade_job'] = jobs_additional_funcs.get_job_view(job)
+                return responses_additional_funcs.MongoResponse(obj)
             raise HTTPException(status_code=404, detail='Could not find an object')
         elif elem[0] != 'role_id' and elem[1] is not None and elem[0] != 'delete_me':
             item_updated['divisions.$[outer].available_roles.$[inner].' + str(elem[0])] = elem[1]
     item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id)},
         {
             '$set': await companies_additional_funcs.fill_in_object_ids_dict(item_updated)
         }, array_filters=array_filters, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await companies_additional_funcs.index_company_roles(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -348,7 +390,7 @@ async def create_doc_type(doc_type: companies_modules.DocTypeCreate,
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id)},
         {
             '$push': {
@@ -360,7 +402,8 @@ async def create_doc_type(doc_type: companies_modules.DocTypeCreate,
             '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -373,12 +416,13 @@ async def edit_doc_type(doc_type: companies_modules.DocTypeEdit,
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
+    await references_additional_funcs.check_references(doc_type, current_user.company_id)
     item_updated = dict()
     for elem in doc_type:
         if elem[0] != 'doc_type_id':
             item_updated['doc_types.$.' + str(elem[0])] = elem[1]
     item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id),
          "doc_types": {"$elemMatch": {"doc_type_id": ObjectId(doc_type.doc_type_id),
                                       "name": {"$nin": config.base_doc_types}}}},
@@ -386,7 +430,8 @@ async def edit_doc_type(doc_type: companies_modules.DocTypeEdit,
             '$set': await companies_additional_funcs.fill_in_object_ids_dict(item_updated)
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -399,7 +444,8 @@ async def create_third_party_folder(third_party_folder: companies_modules.ThirdP
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    obj = config.db.companies.find_one_and_update(
+    await references_additional_funcs.check_references(third_party_folder, current_user.company_id)
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id),
          "third_parties.third_party_id": ObjectId(third_party_folder.third_party_id)},
         {
@@ -412,7 +458,8 @@ async def create_third_party_folder(third_party_folder: companies_modules.ThirdP
             '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
         }, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
@@ -425,52 +472,98 @@ async def edit_third_party_folder(third_party_folder: companies_modules.ThirdPar
             or not current_user.permissions.can_change_company_data:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    available_role_obj = list(config.db.companies.aggregate(
-                [{"$unwind": "$third_parties"},
-                 {"$unwind": "$third_parties.folders"},
-                 {"$match": {"third_parties.folders.third_party_folder_id":
-                             ObjectId(third_party_folder.third_party_folder_id)}}]))[0]
+    await references_additional_funcs.check_references(third_party_folder, current_user.company_id)
+    company = await company_loader.load_company(current_user.company_id)
+    third_party_id = company_loader.get_folder_third_party_id(company,
+                                                              ObjectId(third_party_folder.third_party_folder_id))
     item_updated = dict()
-    array_filters = [{'outer.third_party_id': available_role_obj['third_parties']['third_party_id']},
+    array_filters = [{'outer.third_party_id': third_party_id},
                      {"inner.third_party_folder_id": ObjectId(third_party_folder.third_party_folder_id)}]
     for elem in third_party_folder:
         if elem[0] == 'delete_me' and elem[1]:
-            obj = config.db.companies.find_one_and_update(
+            obj = await config.db.companies.find_one_and_update(
                 {"_id": ObjectId(current_user.company_id),
-                 "third_parties": {"$elemMatch": {"third_party_id":
-                                                  available_role_obj['third_parties']['third_party_id']}}},
+                 "third_parties": {"$elemMatch": {"third_party_id": third_party_id}}},
                 {
-                    '$pull': {"third_parties": {"folders": {"third_party_folder_id":
-                                                            ObjectId(third_party_folder.third_party_folder_id)}}}
-                }, return_document=ReturnDocument.AFTER)
+                    '$pull': {"third_parties.$[outer].folders": {"third_party_folder_id":
+                                                                 ObjectId(third_party_folder.third_party_folder_id)}},
+                    '$set': {"recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}
+                }, array_filters=array_filters[:1], return_document=ReturnDocument.AFTER)
             if obj is not None:
-                config.db.files.update({"third_party_folder_id": ObjectId(third_party_folder.third_party_folder_id),
-                                        "$set": {"third_party_folder_id": None}})
-                return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+                await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+                job = await companies_additional_funcs.enqueue_cascade(current_user.company_id, current_user.id,
+                                                                       'third_party_folder',
+                                                                       third_party_folder.third_party_folder_id)
+                obj['cascade_job'] = jobs_additional_funcs.get_job_view(job)
+                return responses_additional_funcs.MongoResponse(obj)
             raise HTTPException(status_code=404, detail='Could not find an object')
         elif elem[0] != 'third_party_folder_id' and elem[1] is not None and elem[0] != 'delete_me':
             item_updated['third_parties.$[outer].folders.$[inner].' + str(elem[0])] = elem[1]
     item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    obj = config.db.companies.find_one_and_update(
+    obj = await config.db.companies.find_one_and_update(
         {"_id": ObjectId(current_user.company_id)},
         {
             '$set': await companies_additional_funcs.fill_in_object_ids_dict(item_updated)
         }, array_filters=array_filters, return_document=ReturnDocument.AFTER)
     if obj is not None:
-        return await companies_additional_funcs.delete_object_ids_from_dict(obj)
+        await principal_cache.company_changed(current_user.company_id, obj['recent_change'])
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=404, detail='Could not find an object')
 
 
-@router.delete("/delete/{company_id}")
+@router.delete("/delete/{company_id}", status_code=202)
 async def delete_company(company_id, authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.fresh_jwt_required()
     current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
     if current_user.company_id is None or company_id != current_user.company_id:
+        # the company of a delete job that failed for good stays marked as deleting and its users are detached,
+        # the user who requested the delete can run the job again
+        job = None
+        if ObjectId.is_valid(company_id):
+            job = await jobs_additional_funcs.requeue_failed_job({"company_id": ObjectId(company_id),
+                                                                  "kind": 'delete_company',
+                                                                  "created_by": ObjectId(current_user.id)})
+        if job is None:
+            raise HTTPException(status_code=400, detail="No company is attached")
+        return responses_additional_funcs.MongoResponse(jobs_additional_funcs.get_job_view(job), status_code=202)
+    # the users of a company that is being deleted have no access to it, see get_user
+    company = await config.db.companies.find_one_and_update(
+        {"_id": ObjectId(company_id), "deleting": {"$ne": True}},
+        {"$set": {"deleting": True,
+                  "recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')}},
+        return_document=ReturnDocument.AFTER)
+    if company is None:
+        raise HTTPException(status_code=404, detail='Could not find an object')
+    await principal_cache.company_changed(company_id, company['recent_change'])
+    job = await jobs_additional_funcs.enqueue('delete_company', company_id, current_user.id)
+    return responses_additional_funcs.MongoResponse(jobs_additional_funcs.get_job_view(job), status_code=202)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id, authorize: auth_middlewares.AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=400, detail='Not valid Object_id')
+    current_user, job = await asyncio.gather(
+        auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True),
+        config.db.jobs.find_one({"_id": ObjectId(job_id)}))
+    # the user who deleted a company keeps seeing the job after the company is gone
+    if job is None or (str(job['created_by']) != current_user.id
+                       and (current_user.company_id is None or str(job['company_id']) != current_user.company_id)):
+        raise HTTPException(status_code=404, detail='Could not find an object')
+    return responses_additional_funcs.MongoResponse(jobs_additional_funcs.get_job_view(job))
+
+
+@router.get("/cascades")
+async def get_cascades(authorize: auth_middlewares.AuthJWT = Depends()):
+    authorize.jwt_required()
+    current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
+    if current_user.company_id is None:
         raise HTTPException(status_code=400, detail="No company is attached")
-    config.db.files.remove({"_id": ObjectId(company_id)})
-    await companies_additional_funcs.unset_company_at_users_files(company_id)
-    config.db.companies.remove({"_id": ObjectId(company_id)})
-    return dict(msg="The company has been deleted")
+    # files and users may still point at a deleted part of the company while its cascade is not done
+    jobs = await config.db.jobs.find({"company_id": ObjectId(current_user.company_id), "kind": 'cascade',
+                                      "status": {"$in": ['pending', 'running', 'failed']}}).to_list(length=None)
+    return responses_additional_funcs.MongoResponse([jobs_additional_funcs.get_job_view(job) for job in jobs])
 
 
 @router.get("/check-jwt")
@@ -478,4 +571,4 @@ async def get_company_object(authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
     current_company = await companies_additional_funcs.get_company(current_user.company_id)
-    return current_company
+    return responses_additional_funcs.MongoResponse(current_company)
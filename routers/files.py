@@ -1,21 +1,27 @@
-import datetime
+import asyncio
+from typing import List, Optional
 
-from fastapi import File, APIRouter, Depends, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
-from models.files import ItemAddFileInfo, ItemUploadFileEmpty
-from additional_funcs.files import create_preview
+from fastapi import File, APIRouter, Depends, UploadFile, HTTPException, Query
+from fastapi.requests import Request
+from models.files import ItemAddFileInfo, ItemAddFilesInfo, ItemUploadFileEmpty
 from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
 from bson import ObjectId
 from middlewares import auth as auth_middlewares
+from middlewares import company_loader
 from additional_funcs import files as files_additional_funcs
+from additional_funcs import previews as previews_additional_funcs
+from additional_funcs import downloads as downloads_additional_funcs
+from additional_funcs import responses as responses_additional_funcs
+from additional_funcs import references as references_additional_funcs
 import config
-import os
 
 
 router = APIRouter(
     prefix="/files",
     tags=["files"],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    route_class=responses_additional_funcs.NegotiatedRoute
 )
 
 
@@ -28,29 +34,74 @@ async def create_file(authorize: auth_middlewares.AuthJWT = Depends(),
             or current_user.permissions is None or not current_user.permissions.can_upload_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    file_read = await file.read()
-    with open(f'files/{file.filename}', 'wb') as doc:
-        doc.write(file_read)
-        file_size = len(file_read)
-    preview_link, file_object_id = await create_preview(f'files/{file.filename}')
-    os.rename(f'files/{file.filename}', f'files/{file_object_id}.{file.filename.split(".")[-1]}')
-    info_dict = {
-            "name": file.filename,
-            "path": f'files/{file_object_id}.{file.filename.split(".")[-1]}',
-            "content_type": file.content_type,
-            "size": file_size,
-            "preview_path": preview_link,
-            "upload_date": (datetime.datetime.now()).strftime("%d.%m.%Y %H:%M:%S"),
-            "uploaded_by": ObjectId(current_user.id),
-            "company_id": ObjectId(current_user.company_id),
-            "recent_change": str(datetime.datetime.now().timestamp()).replace('.', '')
-    }
-    info_dict_of_an_empty_doc = ItemUploadFileEmpty().__dict__
-    for key in info_dict_of_an_empty_doc.keys():
-        info_dict[key] = info_dict_of_an_empty_doc[key]
-    config.db.files.insert_one(info_dict)
-    info_dict = await files_additional_funcs.delete_object_ids_from_dict(info_dict)
-    return info_dict
+    company = await company_loader.load_company(current_user.company_id)
+    max_size = (company or dict()).get('subscription', dict()).get('upload_size_limit') or config.max_upload_size
+    file_object_id = ObjectId()
+    tmp_path, file_size, file_sha256 = await files_additional_funcs.save_upload_file(file, file_object_id, max_size)
+    blob, is_new_blob = await files_additional_funcs.commit_upload_blob(tmp_path, file_sha256,
+                                                                        file.filename.split(".")[-1], file_size)
+    info_dict = files_additional_funcs.get_uploaded_file_info(file_object_id, file, blob, file_size, file_sha256,
+                                                              current_user.id, current_user.company_id,
+                                                              ItemUploadFileEmpty().__dict__)
+    await config.db.files.insert_one(info_dict)
+    if is_new_blob or blob['preview_status'] == 'failed':
+        previews_additional_funcs.schedule_preview(file_sha256, blob['path'])
+    elif blob['preview_status'] == 'pending':
+        # the preview of the reused blob may have been finished before this file was inserted
+        await previews_additional_funcs.sync_file_preview(file_object_id, file_sha256)
+    return responses_additional_funcs.MongoResponse(info_dict)
+
+
+@router.post("/upload-batch")
+async def create_files(authorize: auth_middlewares.AuthJWT = Depends(),
+                       files: List[UploadFile] = File(...)):
+    authorize.jwt_required()
+    current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
+    if current_user.company_id is None \
+            or current_user.permissions is None or not current_user.permissions.can_upload_files:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    if len(files) > config.upload_batch_max_files:
+        raise HTTPException(status_code=400, detail=f'At most {config.upload_batch_max_files} files '
+                                                    f'can be uploaded at once')
+    company = await company_loader.load_company(current_user.company_id)
+    max_size = (company or dict()).get('subscription', dict()).get('upload_size_limit') or config.max_upload_size
+    semaphore = asyncio.Semaphore(config.upload_batch_concurrency)
+    results = await asyncio.gather(*[files_additional_funcs.store_batch_file(file, max_size, semaphore)
+                                     for file in files])
+    stored = [(file, result) for file, result in zip(files, results) if result['status'] == 'uploaded']
+    info_dicts = [files_additional_funcs.get_uploaded_file_info(result['file_object_id'], file, result['blob'],
+                                                                result['size'], result['sha256'], current_user.id,
+                                                                current_user.company_id,
+                                                                ItemUploadFileEmpty().__dict__)
+                  for file, result in stored]
+    not_inserted = set()
+    if len(info_dicts) != 0:
+        try:
+            await config.db.files.insert_many(info_dicts, ordered=False)
+        except BulkWriteError as e:
+            print(e)
+            not_inserted = {error['index'] for error in e.details['writeErrors']}
+    new_previews = dict()
+    pending_previews = list()
+    for index, (info_dict, (file, result)) in enumerate(zip(info_dicts, stored)):
+        blob, is_new_blob = result['blob'], result['is_new_blob']
+        result.clear()
+        if index in not_inserted:
+            await files_additional_funcs.release_file_blob(info_dict)
+            result.update(name=file.filename, status='failed', detail='Could not save the file')
+            continue
+        result.update(name=file.filename, status='uploaded', file=info_dict)
+        # the previews are rendered after the insert, so they reach every file of their blob
+        if is_new_blob or blob['preview_status'] == 'failed':
+            new_previews[blob['_id']] = blob['path']
+        elif blob['preview_status'] == 'pending':
+            pending_previews.append(previews_additional_funcs.sync_file_preview(info_dict['_id'], blob['_id']))
+    if len(new_previews) != 0:
+        previews_additional_funcs.schedule_previews(list(new_previews.items()))
+    # previews of reused blobs may have been finished before their files were inserted
+    await asyncio.gather(*pending_previews)
+    return responses_additional_funcs.MongoResponse(dict(files=results))
 
 
 @router.post("/add_info")
@@ -61,74 +112,129 @@ async def add_file_info(data: ItemAddFileInfo, authorize: auth_middlewares.AuthJ
             or current_user.permissions is None or not current_user.permissions.can_upload_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    item_updated = dict()
+    await references_additional_funcs.check_references(data, current_user.company_id)
     file_id = data.file_id
 
     if data.third_party_folder_id is not None and data.third_party_id is None:
-        file = config.db.files.find_one({'_id': ObjectId(file_id),
-                                         'company_id': ObjectId(current_user.company_id)})
+        file = await config.db.files.find_one({'_id': ObjectId(file_id),
+                                               'company_id': ObjectId(current_user.company_id)})
         if file is None or file['third_party_id'] is None:
             raise HTTPException(status_code=400, detail='Attempt to set folder id to the file without third_party')
+        # a file in a folder carries the third_party_id of that folder, the listings rely on it
+        company = await company_loader.load_company(current_user.company_id)
+        if company is None or ObjectId(data.third_party_folder_id) not in \
+                company_loader.get_third_party_folder_ids(company, file['third_party_id']):
+            raise HTTPException(status_code=400, detail='Folder id not attached to the file third_party')
     elif data.third_party_folder_id is not None and data.third_party_id is not None:
-        obj = config.db.companies.find_one({'_id': ObjectId(current_user.company_id),
-                                            "third_parties": {
-                                                "$elemMatch": {
-                                                    "third_party_id": ObjectId(data.third_party_id),
-                                                    "folders": {
-                                                        "$elemMatch": {
-                                                            "third_party_folder_id":
-                                                                ObjectId(data.third_party_folder_id)}}}}})
-        if obj is None:
+        company = await company_loader.load_company(current_user.company_id)
+        if company is None or ObjectId(data.third_party_folder_id) not in \
+                company_loader.get_third_party_folder_ids(company, ObjectId(data.third_party_id)):
             raise HTTPException(status_code=400, detail='Folder id not attached to company third_party')
 
-    for elem in data:
-        if elem[0][-3:] == '_id' and elem[0] != 'file_id' and elem[1] is not None and elem[0][:6] != 'delete':
-            await files_additional_funcs.check_if_ids_are_connected_to_the_company(elem, current_user.company_id,
-                                                                                   file_id)
-        if elem[0] != 'file_id' and elem[1] is not None and elem[0][:6] != 'delete':
-            item_updated[str(elem[0])] = elem[1]
-        elif elem[0][:6] == 'delete' and elem[1]:
-            item_updated[str(elem[0][7:])] = elem[1]
-    item_updated = await files_additional_funcs.fill_in_object_ids_dict(item_updated)
-    item_updated["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    obj = config.db.files.find_one_and_update({'_id': ObjectId(file_id),
-                                               'company_id': ObjectId(current_user.company_id)},
-                                              {'$set': item_updated}, return_document=ReturnDocument.AFTER)
+    item_updated = await files_additional_funcs.get_file_info_update(data)
+    obj = await config.db.files.find_one_and_update({'_id': ObjectId(file_id),
+                                                     'company_id': ObjectId(current_user.company_id)},
+                                                    {'$set': item_updated}, return_document=ReturnDocument.AFTER)
     if obj is not None:
         new_set_also = dict()
         if data.delete_third_party_id or (data.third_party_id is not None and data.third_party_folder_id is None):
             new_set_also["third_party_folder_id"] = None
         if data.parent_id is not None:
-            file = config.db.files.find_one({"_id": ObjectId(data.parent_id)})
-            new_set_also["third_party_folder_id"] = file["third_party_folder_id"]
-            new_set_also["third_party_id"] = file["third_party_id"]
+            file = await config.db.files.find_one({"_id": ObjectId(data.parent_id),
+                                                   'company_id': ObjectId(current_user.company_id)},
+                                                  {"third_party_id": 1, "third_party_folder_id": 1})
+            if file is not None:
+                third_party_folder_id = file.get("third_party_folder_id")
+                if third_party_folder_id is not None:
+                    company = await company_loader.load_company(current_user.company_id)
+                    if company is None or third_party_folder_id not in \
+                            company_loader.get_third_party_folder_ids(company, file.get("third_party_id")):
+                        third_party_folder_id = None
+                new_set_also["third_party_folder_id"] = third_party_folder_id
+                new_set_also["third_party_id"] = file.get("third_party_id")
         if len(new_set_also) != 0:
-            obj = config.db.files.find_one_and_update({'_id': ObjectId(file_id),
-                                                       'company_id': ObjectId(current_user.company_id)},
-                                                      {'$set': new_set_also},
-                                                      return_document=ReturnDocument.AFTER)
-        obj = await files_additional_funcs.delete_object_ids_from_dict(obj)
-        return obj
+            obj = await config.db.files.find_one_and_update({'_id': ObjectId(file_id),
+                                                             'company_id': ObjectId(current_user.company_id)},
+                                                            {'$set': new_set_also},
+                                                            return_document=ReturnDocument.AFTER)
+        return responses_additional_funcs.MongoResponse(obj)
     raise HTTPException(status_code=400, detail='No such Object_id was found')
 
 
+@router.post("/add_info_bulk")
+async def add_files_info(data: ItemAddFilesInfo, authorize: auth_middlewares.AuthJWT = Depends()):
+    authorize.jwt_required()
+    current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
+    if current_user.company_id is None \
+            or current_user.permissions is None or not current_user.permissions.can_upload_files:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    info = data.info
+    await references_additional_funcs.check_references(info, current_user.company_id, ('body', 'info'))
+    files_filter = {"company_id": ObjectId(current_user.company_id)}
+    if data.file_ids is not None:
+        file_ids = list(dict.fromkeys(ObjectId(elem) for elem in data.file_ids))
+        if len(file_ids) > config.bulk_update_max_files:
+            raise HTTPException(status_code=400, detail=f'At most {config.bulk_update_max_files} files '
+                                                        f'can be changed at once')
+        files_filter["_id"] = {"$in": file_ids}
+    else:
+        files_filter.update({key: ObjectId(value) for key, value in data.filter if value is not None})
+    files = await config.db.files.find(files_filter, {"third_party_id": 1}).sort("_id", 1).to_list(
+        length=config.bulk_update_max_files + 1)
+    if len(files) > config.bulk_update_max_files:
+        raise HTTPException(status_code=400, detail=f'More than {config.bulk_update_max_files} files '
+                                                    f'match the filter')
+    if data.file_ids is None:
+        file_ids = [file['_id'] for file in files]
+
+    # a folder can be set only on the files of its third party
+    folder_third_party_id = None
+    if info.third_party_folder_id is not None:
+        company = await company_loader.load_company(current_user.company_id)
+        folder_third_party_id = company_loader.get_folder_third_party_id(company, ObjectId(info.third_party_folder_id))
+        if info.third_party_id is not None and ObjectId(info.third_party_id) != folder_third_party_id:
+            raise HTTPException(status_code=400, detail='Folder id not attached to company third_party')
+    outcomes = {file_id: dict(file_id=file_id, status='not_found') for file_id in file_ids}
+    to_update = list()
+    for file in files:
+        if folder_third_party_id is not None and info.third_party_id is None \
+                and file.get('third_party_id') != folder_third_party_id:
+            outcomes[file['_id']].update(status='failed', detail='Folder id not attached to the file third_party')
+        else:
+            to_update.append(file['_id'])
+
+    item_updated = await files_additional_funcs.get_file_info_update(info)
+    if info.delete_third_party_id or (info.third_party_id is not None and info.third_party_folder_id is None):
+        item_updated["third_party_folder_id"] = None
+    if len(to_update) != 0:
+        result = await config.db.files.update_many({"_id": {"$in": to_update},
+                                                    "company_id": ObjectId(current_user.company_id)},
+                                                   {"$set": item_updated})
+        if result.matched_count != len(to_update):
+            # files deleted after they were read
+            to_update = await config.db.files.distinct("_id", {"_id": {"$in": to_update},
+                                                               "company_id": ObjectId(current_user.company_id)})
+        for file_id in to_update:
+            outcomes[file_id]['status'] = 'updated'
+    return responses_additional_funcs.MongoResponse(
+        dict(updated=len(to_update), files=list(outcomes.values())))
+
+
 @router.delete("/delete/{file_id}")
 async def delete_file(file_id, authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     if not ObjectId.is_valid(file_id):
         raise HTTPException(status_code=400, detail='Not valid Object_id')
-    file = config.db.files.find_one({"_id": ObjectId(file_id)})
-    current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
+    file, current_user = await asyncio.gather(
+        config.db.files.find_one({"_id": ObjectId(file_id)}),
+        auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True))
     if current_user.company_id is None or file is None or str(file['company_id']) != current_user.company_id \
             or current_user.permissions is None or not current_user.permissions.can_upload_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    config.db.files.remove({"_id": ObjectId(file_id)})
-    try:
-        os.remove(file['path'])
-        os.remove(file['preview_path'])
-    except FileNotFoundError as e:
-        print(e)
+    await config.db.files.delete_one({"_id": ObjectId(file_id)})
+    await files_additional_funcs.release_file_blob(file)
     return dict(msg="The file has been deleted")
 
 
@@ -137,131 +243,100 @@ async def get_file(file_id, authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     if not ObjectId.is_valid(file_id):
         raise HTTPException(status_code=400, detail='Not valid Object_id')
-    file = config.db.files.find_one({"_id": ObjectId(file_id)})
-    current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
+    file, current_user = await asyncio.gather(
+        config.db.files.find_one({"_id": ObjectId(file_id)}),
+        auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True))
     if current_user.company_id is None or file is None or str(file['company_id']) != current_user.company_id \
             or current_user.permissions is None or not current_user.permissions.can_download_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    file = await files_additional_funcs.delete_object_ids_from_dict(file)
-    return file
+    return responses_additional_funcs.MongoResponse(file)
 
 
 @router.get("/get-by-third-party/{third_party_id}")
-async def get_file_by_third_party_id(third_party_id, authorize: auth_middlewares.AuthJWT = Depends()):
+async def get_file_by_third_party_id(third_party_id, cursor: Optional[str] = None,
+                                    limit: int = Query(config.listing_page_size, ge=1,
+                                                       le=config.listing_max_page_size),
+                                    authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     if not ObjectId.is_valid(third_party_id):
         raise HTTPException(status_code=400, detail='Not valid Object_id')
-    company = list(config.db.companies.aggregate([{"$unwind": "$third_parties"},
-                                                  {"$match": {
-                                                      "third_parties.third_party_id": ObjectId(third_party_id)}}]))
     current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
-    if current_user.company_id is None or len(company) != 1 \
-            or str(company[0]['_id']) != current_user.company_id \
+    if current_user.company_id is None \
             or current_user.permissions is None or not current_user.permissions.can_download_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    company = company[0]
-
-    files_not_in_folders = config.db.files.find({
-            'third_party_id': ObjectId(third_party_id),
-            'third_party_folder_id': None})
-    files_with_doc_types = dict()
-    files_without_doc_types = list()
-    for file in files_not_in_folders:
-        doc_type_id = file['doc_type_id']
-        [file.pop(key) for key in file.copy().keys() if key not in config.content_to_response]
-        if doc_type_id is not None and str(doc_type_id) not in files_with_doc_types:
-            files_with_doc_types[str(doc_type_id)] = dict()
-            files_with_doc_types[str(doc_type_id)]['name'] = \
-                next(item for item in company['doc_types'] if str(item['doc_type_id']) == str(doc_type_id))['name']
-            files_with_doc_types[str(doc_type_id)]['files'] = list()
-            files_with_doc_types[str(doc_type_id)]['files'].append(file)
-        elif doc_type_id is not None:
-            files_with_doc_types[str(doc_type_id)]['files'].append(file)
-        else:
-            files_without_doc_types.append(file)
-    files_not_in_folders = dict()
-    files_not_in_folders['without_doc_type'] = files_without_doc_types
-    files_not_in_folders['with_doc_type'] = files_with_doc_types
+    files_match = {"company_id": ObjectId(current_user.company_id), "third_party_id": ObjectId(third_party_id)}
+    if cursor is not None:
+        files_match["_id"] = {"$gt": files_additional_funcs.decode_cursor(cursor)}
+    # files in a folder always carry the third_party_id of that folder, add_info and add_info_bulk check it
+    company = await files_additional_funcs.aggregate_file_listing(
+        [{"$match": {"_id": ObjectId(current_user.company_id),
+                     "third_parties.third_party_id": ObjectId(third_party_id)}},
+         {"$project": {"doc_types": 1,
+                       "third_party": {"$arrayElemAt": [{"$filter": {
+                           "input": "$third_parties",
+                           "cond": {"$eq": ["$$this.third_party_id", ObjectId(third_party_id)]}}}, 0]}}}],
+        files_match, limit)
+    if company is None:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    doc_type_names = {str(doc_type['doc_type_id']): doc_type['name'] for doc_type in company['doc_types']}
+    file_groups, next_cursor = files_additional_funcs.cut_file_page(company['file_groups'], limit)
+    listings = files_additional_funcs.group_files_by_folder(file_groups, doc_type_names)
 
     files_in_folders = dict()
-    folders = company['third_parties']['folders']
-    for folder in folders:
-        third_party_folder_id = ObjectId(folder['third_party_folder_id'])
-        files = config.db.files.find({'third_party_folder_id': third_party_folder_id})
-        files_with_doc_types = dict()
-        files_without_doc_types = list()
-        for file in files:
-            doc_type_id = file['doc_type_id']
-            [file.pop(key) for key in file.copy().keys() if key not in config.content_to_response]
-            if doc_type_id is not None and str(doc_type_id) not in files_with_doc_types:
-                files_with_doc_types[str(doc_type_id)] = dict()
-                files_with_doc_types[str(doc_type_id)]['name'] = \
-                    next(item for item in company['doc_types'] if str(item['doc_type_id']) == str(doc_type_id))['name']
-                files_with_doc_types[str(doc_type_id)]['files'] = list()
-                files_with_doc_types[str(doc_type_id)]['files'].append(file)
-            elif doc_type_id is not None:
-                files_with_doc_types[str(doc_type_id)]['files'].append(file)
-            else:
-                files_without_doc_types.append(file)
-        files_in_folders[str(third_party_folder_id)] = dict()
-        files_in_folders[str(third_party_folder_id)]['name'] = \
-            next(item for item in company['third_parties']['folders']
-                 if str(item['third_party_folder_id']) == str(third_party_folder_id))['name']
-        files_in_folders[str(third_party_folder_id)]['without_doc_type'] = files_without_doc_types
-        files_in_folders[str(third_party_folder_id)]['with_doc_type'] = files_with_doc_types
+    for folder in company['third_party']['folders']:
+        files_in_folders[str(folder['third_party_folder_id'])] = dict(
+            name=folder['name'],
+            **listings.get(folder['third_party_folder_id'], files_additional_funcs.get_empty_listing()))
 
     dict_to_return = dict()
-    dict_to_return['name'] = company['third_parties']['name']
-    dict_to_return['files_not_in_folders'] = files_not_in_folders
+    dict_to_return['name'] = company['third_party']['name']
+    dict_to_return['files_not_in_folders'] = listings.get(None, files_additional_funcs.get_empty_listing())
     dict_to_return['files_in_folders'] = files_in_folders
-    dict_to_return = await files_additional_funcs.delete_object_ids_from_dict(dict_to_return)
-    return dict_to_return
+    dict_to_return['next_cursor'] = next_cursor
+    return responses_additional_funcs.MongoResponse(dict_to_return)
 
 
 @router.get("/get-by-third-party-folder-id/{third_party_folder_id}")
-async def get_file_by_third_party_folder_id(third_party_folder_id, authorize: auth_middlewares.AuthJWT = Depends()):
+async def get_file_by_third_party_folder_id(third_party_folder_id, cursor: Optional[str] = None,
+                                           limit: int = Query(config.listing_page_size, ge=1,
+                                                              le=config.listing_max_page_size),
+                                           authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     if not ObjectId.is_valid(third_party_folder_id):
         raise HTTPException(status_code=400, detail='Not valid Object_id')
-    company = list(config.db.companies.aggregate(
-        [{"$unwind": "$third_parties"},
-         {"$unwind": "$third_parties.folders"},
-         {"$match": {"third_parties.folders.third_party_folder_id": ObjectId(third_party_folder_id)}}]))
     current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
-    if current_user.company_id is None or len(company) != 1 \
-            or str(company[0]['_id']) != current_user.company_id \
+    if current_user.company_id is None \
             or current_user.permissions is None or not current_user.permissions.can_download_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-
-    files_in_folder = config.db.files.find({
-            'third_party_folder_id': ObjectId(third_party_folder_id)})
-    files_with_doc_types = dict()
-    files_without_doc_types = list()
-    for file in files_in_folder:
-        doc_type_id = file['doc_type_id']
-        [file.pop(key) for key in file.copy().keys() if key not in config.content_to_response]
-        if doc_type_id is not None and str(doc_type_id) not in files_with_doc_types:
-            files_with_doc_types[str(doc_type_id)] = dict()
-            files_with_doc_types[str(doc_type_id)]['name'] = \
-                next(item for item in company[0]['doc_types'] if str(item['doc_type_id']) == str(doc_type_id))['name']
-            files_with_doc_types[str(doc_type_id)]['files'] = list()
-            files_with_doc_types[str(doc_type_id)]['files'].append(file)
-        elif doc_type_id is not None:
-            files_with_doc_types[str(doc_type_id)]['files'].append(file)
-        else:
-            files_without_doc_types.append(file)
-    files_in_folder = dict()
-    files_in_folder['without_doc_type'] = files_without_doc_types
-    files_in_folder['with_doc_type'] = files_with_doc_types
+    files_match = {"company_id": ObjectId(current_user.company_id),
+                   "third_party_folder_id": ObjectId(third_party_folder_id)}
+    if cursor is not None:
+        files_match["_id"] = {"$gt": files_additional_funcs.decode_cursor(cursor)}
+    company = await files_additional_funcs.aggregate_file_listing(
+        [{"$match": {"_id": ObjectId(current_user.company_id),
+                     "third_parties.folders.third_party_folder_id": ObjectId(third_party_folder_id)}},
+         {"$unwind": "$third_parties"},
+         {"$unwind": "$third_parties.folders"},
+         {"$match": {"third_parties.folders.third_party_folder_id": ObjectId(third_party_folder_id)}},
+         {"$project": {"doc_types": 1, "folder": "$third_parties.folders"}}],
+        files_match, limit)
+    if company is None:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    doc_type_names = {str(doc_type['doc_type_id']): doc_type['name'] for doc_type in company['doc_types']}
+    file_groups, next_cursor = files_additional_funcs.cut_file_page(company['file_groups'], limit)
+    listings = files_additional_funcs.group_files_by_folder(file_groups, doc_type_names)
 
     dict_to_return = dict()
-    dict_to_return['name'] = company[0]['third_parties']['folders']['name']
-    dict_to_return['files_in_folders'] = files_in_folder
-    dict_to_return = await files_additional_funcs.delete_object_ids_from_dict(dict_to_return)
-    return dict_to_return
+    dict_to_return['name'] = company['folder']['name']
+    dict_to_return['files_in_folders'] = listings.get(ObjectId(third_party_folder_id),
+                                                      files_additional_funcs.get_empty_listing())
+    dict_to_return['next_cursor'] = next_cursor
+    return responses_additional_funcs.MongoResponse(dict_to_return)
 
 
 @router.get("/get-file-history/{file_id}")
@@ -269,56 +344,135 @@ async def get_file_history(file_id, authorize: auth_middlewares.AuthJWT = Depend
     authorize.jwt_required()
     if not ObjectId.is_valid(file_id):
         raise HTTPException(status_code=400, detail='Not valid Object_id')
-    file = config.db.files.find_one({"_id": ObjectId(file_id)})
     current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
-    if current_user.company_id is None or file is None or str(file['company_id']) != current_user.company_id \
+    if current_user.company_id is None \
             or current_user.permissions is None or not current_user.permissions.can_download_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
-    history_list = list()
-    history_list.append(file)
-    if file['parent_id'] is not None:
-        file_history = await files_additional_funcs.search_for_parents(str(file['parent_id']), history_list)
-        [[file.pop(key) for key in file.copy().keys()
-          if key not in config.content_to_response] for file in file_history]
-        return await files_additional_funcs.delete_object_ids_from_list(file_history)
+    file_history = await files_additional_funcs.get_file_history(file_id, current_user.company_id)
+    if file_history is None:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    if len(file_history) > 1:
+        return responses_additional_funcs.MongoResponse(file_history)
     raise HTTPException(status_code=400, detail='Object does not have any parents')
 
 
-@router.get("/uploads/cache/{file_id}")
-async def get_uploaded_preview_file(file_id, authorize: auth_middlewares.AuthJWT = Depends()):
+@router.get("/get-file-tree/{file_id}")
+async def get_file_tree(file_id, authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     if not ObjectId.is_valid(file_id):
         raise HTTPException(status_code=400, detail='Not valid Object_id')
-    file = config.db.files.find_one({"_id": ObjectId(file_id)})
     current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
+    if current_user.company_id is None \
+            or current_user.permissions is None or not current_user.permissions.can_download_files:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    file_tree = await files_additional_funcs.get_file_tree(file_id, current_user.company_id)
+    if file_tree is None:
+        raise HTTPException(status_code=404, detail='Could not find an object')
+    return responses_additional_funcs.MongoResponse(file_tree)
+
+
+@router.get("/preview-status/{file_id}")
+async def get_preview_status(file_id, authorize: auth_middlewares.AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not ObjectId.is_valid(file_id):
+        raise HTTPException(status_code=400, detail='Not valid Object_id')
+    file, current_user = await asyncio.gather(
+        config.db.files.find_one({"_id": ObjectId(file_id)}, {"company_id": 1, "preview_path": 1,
+                                                              "preview_status": 1}),
+        auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True))
+    if current_user.company_id is None or file is None or str(file['company_id']) != current_user.company_id \
+            or current_user.permissions is None or not current_user.permissions.can_download_files:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    return dict(preview_status=file.get('preview_status', 'ready'), preview_path=file['preview_path'])
+
+
+@router.get("/uploads/cache/{file_id}")
+async def get_uploaded_preview_file(file_id, request: Request, authorize: auth_middlewares.AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not ObjectId.is_valid(file_id):
+        raise HTTPException(status_code=400, detail='Not valid Object_id')
+    file, current_user = await asyncio.gather(
+        config.db.files.find_one({"_id": ObjectId(file_id)}),
+        auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True))
     if current_user.company_id is None or file is None or str(file['company_id']) != current_user.company_id \
             or current_user.permissions is None or not current_user.permissions.can_upload_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
+    if file.get('preview_status', 'ready') != 'ready' or file['preview_path'] is None:
+        raise HTTPException(status_code=404, detail='preview is not ready')
     try:
-        return StreamingResponse(open(file['preview_path'], mode="rb"))
+        preview_disk_path = await previews_additional_funcs.get_preview_file(file['preview_path'], file['path'])
+        # preview names are unique per render, the name itself identifies the content
+        return await downloads_additional_funcs.file_response(
+            request, preview_disk_path, previews_additional_funcs.get_preview_media_type(preview_disk_path),
+            downloads_additional_funcs.make_etag(preview_disk_path.split('/')[-1]), config.preview_cache_control)
+    except previews_additional_funcs.PreviewQueueFull as e:
+        print(e)
+        raise HTTPException(status_code=503, detail='Preview queue is full, try again later')
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=404, detail='file not found')
+
 
+@router.get("/uploads/cache/{file_id}/variant")
+async def get_uploaded_preview_variant(file_id, request: Request, page: int = Query(0, ge=0),
+                                       size: int = Query(256, ge=config.preview_variant_min_size,
+                                                         le=config.preview_variant_max_size),
+                                       image_format: str = Query('jpeg', alias='format',
+                                                                 regex='^(' + '|'.join(
+                                                                     config.preview_variant_formats) + ')$'),
+                                       authorize: auth_middlewares.AuthJWT = Depends()):
+    authorize.jwt_required()
+    if not ObjectId.is_valid(file_id):
+        raise HTTPException(status_code=400, detail='Not valid Object_id')
+    file, current_user = await asyncio.gather(
+        config.db.files.find_one({"_id": ObjectId(file_id)}, {"company_id": 1, "path": 1, "sha256": 1}),
+        auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True))
+    if current_user.company_id is None or file is None or str(file['company_id']) != current_user.company_id \
+            or current_user.permissions is None or not current_user.permissions.can_upload_files:
+        raise HTTPException(status_code=400, detail='Company is not attached to the user'
+                                                    ' or does not have permissions for that action')
+    try:
+        variant_path = await previews_additional_funcs.get_preview_variant(file.get('sha256') or str(file['_id']),
+                                                                           file['path'], page, size, image_format)
+    except previews_additional_funcs.PreviewQueueFull as e:
+        print(e)
+        raise HTTPException(status_code=503, detail='Preview queue is full, try again later')
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=404, detail='Could not make a preview of that page')
+    try:
+        return await downloads_additional_funcs.file_response(
+            request, variant_path, config.preview_variant_formats[image_format],
+            downloads_additional_funcs.make_etag(variant_path.split('/')[-1]), config.preview_cache_control)
     except FileNotFoundError as e:
         print(e)
         raise HTTPException(status_code=404, detail='file not found')
 
 
 @router.get("/uploads/files/{file_id}")
-async def get_uploaded_file(file_id, authorize: auth_middlewares.AuthJWT = Depends()):
+async def get_uploaded_file(file_id, request: Request, authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     if not ObjectId.is_valid(file_id):
         raise HTTPException(status_code=400, detail='Not valid Object_id')
-    file = config.db.files.find_one({"_id": ObjectId(file_id)})
-    current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
+    file, current_user = await asyncio.gather(
+        config.db.files.find_one({"_id": ObjectId(file_id)}),
+        auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True))
     if current_user.company_id is None or file is None or str(file['company_id']) != current_user.company_id \
             or current_user.permissions is None or not current_user.permissions.can_download_files:
         raise HTTPException(status_code=400, detail='Company is not attached to the user'
                                                     ' or does not have permissions for that action')
+    if file.get('sha256') is not None:
+        etag = downloads_additional_funcs.make_etag(file['sha256'])
+    else:
+        etag = downloads_additional_funcs.make_etag(file['_id'], file['recent_change'])
     try:
-        return FileResponse(file['path'],
-                            media_type=file['content_type'],
-                            filename=file['name'])
+        return await downloads_additional_funcs.download_response(request, file['path'], file['content_type'], etag,
+                                                                  config.file_cache_control, filename=file['name'])
 
     except FileNotFoundError as e:
         print(e)
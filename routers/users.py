@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 
 from fastapi import APIRouter, Depends, HTTPException
@@ -7,13 +8,17 @@ import config
 from fastapi.requests import Request
 from middlewares import auth as auth_middlewares
 from additional_funcs import users as users_additional_funcs
+from additional_funcs import serialization as serialization_additional_funcs
+from additional_funcs import responses as responses_additional_funcs
+from additional_funcs import references as references_additional_funcs
 from models import users as users_modules
 
 
 router = APIRouter(
     prefix="/users",
     tags=["users"],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    route_class=responses_additional_funcs.NegotiatedRoute
 )
 
 
@@ -22,15 +27,17 @@ async def signup(request: Request, user: users_modules.ItemUserSignUp,
                  authorize: auth_middlewares.AuthJWT = Depends()):
     if not await users_additional_funcs.check_if_data_is_free_for_registration(user.email, user.phone):
         raise HTTPException(status_code=400, detail='Email or phone are already registered')
+    await references_additional_funcs.check_signup_references(user)
     info_dict = user.dict()
     info_dict["password"] = auth_middlewares.get_password_hash(user.password)
     info_dict["recent_change"] = str(datetime.datetime.now().timestamp()).replace('.', '')
-    config.db.users.insert_one(info_dict)
-    info_dict = await users_additional_funcs.delete_object_ids_from_dict(info_dict)
+    await config.db.users.insert_one(info_dict)
+    info_dict = serialization_additional_funcs.delete_object_ids(info_dict)
     session_id = await users_additional_funcs.update_last_login(info_dict['_id'], request.headers.get("user-agent"))
     await auth_middlewares.create_tokens_on_login_or_signup(authorize, info_dict['_id'], session_id,
                                                             request.headers.get("user-agent"))
     del info_dict['password']
+    # the token cookies are set on the response fastapi builds, so routes that log in return plain values
     return info_dict
 
 
@@ -54,28 +61,24 @@ async def login_for_access_token(request: Request, user: users_modules.ItemUserL
 async def refresh(authorize: auth_middlewares.AuthJWT = Depends()):
     # checking if refresh token is available for refresh
     authorize.jwt_refresh_token_required()
-    await auth_middlewares.revoke_token(authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp'])
+    revoked = [(authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp'])]
     current_user = authorize.get_jwt_subject()
-    # refresh refresh token
-    new_refresh_token = authorize.create_refresh_token(subject=current_user)
-    authorize.set_refresh_cookies(new_refresh_token)
-    jti = authorize.get_jti(new_refresh_token)
-    await additional_funcs.users.insert_jti_in_session_id(user_id=current_user[:24],
-                                                          session_id=current_user[24:],
-                                                          jti_refresh=jti)
-    # refresh access token
-    new_access_token = authorize.create_access_token(subject=current_user)
-    authorize.set_access_cookies(new_access_token)
-    jti = authorize.get_jti(new_access_token)
-    await additional_funcs.users.insert_jti_in_session_id(user_id=current_user[:24],
-                                                          session_id=current_user[24:],
-                                                          jti_access=jti)
     # checking if access token is available for refresh to revoke it
     try:
         authorize.jwt_required()
-        await auth_middlewares.revoke_token(authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp'])
+        revoked.append((authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp']))
     except Exception as e:
         print(e)
+    new_refresh_token = authorize.create_refresh_token(subject=current_user)
+    new_access_token = authorize.create_access_token(subject=current_user)
+    # the old tokens are revoked in one redis round trip and the new jtis are stored in one write
+    await asyncio.gather(auth_middlewares.revoke_tokens(revoked),
+                         additional_funcs.users.insert_jti_in_session_id(
+                             user_id=current_user[:24], session_id=current_user[24:],
+                             jti_refresh=authorize.get_jti(new_refresh_token),
+                             jti_access=authorize.get_jti(new_access_token)))
+    authorize.set_refresh_cookies(new_refresh_token)
+    authorize.set_access_cookies(new_access_token)
     return dict(msg="The token has been refreshed")
 
 
@@ -112,10 +115,14 @@ async def refresh_revoke(authorize: auth_middlewares.AuthJWT = Depends()):
 async def logout_and_delete_access_token(authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     sub = authorize.get_jwt_subject()
-    await additional_funcs.users.unset_active_session_in_db(user_id=sub[:24], session_id=sub[24:])
-    await auth_middlewares.revoke_token(authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp'])
-    authorize.jwt_refresh_token_required()
-    await auth_middlewares.revoke_token(authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp'])
+    tokens = [(authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp'])]
+    # the session is closed even without a valid refresh token, its stored jtis are revoked anyway
+    try:
+        authorize.jwt_refresh_token_required()
+        tokens.append((authorize.get_raw_jwt()['jti'], authorize.get_raw_jwt()['exp']))
+    except Exception as e:
+        print(e)
+    await additional_funcs.users.unset_active_session_in_db(user_id=sub[:24], session_id=sub[24:], tokens=tokens)
     authorize.unset_jwt_cookies()
     return dict(msg="logout success")
 
@@ -124,4 +131,4 @@ async def logout_and_delete_access_token(authorize: auth_middlewares.AuthJWT = D
 async def get_user_object(authorize: auth_middlewares.AuthJWT = Depends()):
     authorize.jwt_required()
     current_user = await auth_middlewares.get_user(authorize.get_jwt_subject(), _id_check=True)
-    return current_user
+    return responses_additional_funcs.MongoResponse(current_user)